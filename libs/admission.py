@@ -0,0 +1,107 @@
+import ipaddress
+import os
+import threading
+import time
+from libs.rate_limit import TokenBucket, parse_rate
+
+# Connections allowed at once from one IP address and from one /24 (IPv6: /64)
+MAX_CONNECTIONS_PER_IP = int(os.getenv("MAX_CONNECTIONS_PER_IP", "5"))
+MAX_CONNECTIONS_PER_SUBNET = int(os.getenv("MAX_CONNECTIONS_PER_SUBNET", "20"))
+# New connections accepted, as "count/seconds" over the whole server
+ACCEPT_RATE = parse_rate(os.getenv("ACCEPT_RATE", "20/1"))
+# Connections the kernel queues before accept(), separate from MAX_CONNECTIONS
+LISTEN_BACKLOG = int(os.getenv("LISTEN_BACKLOG", "128"))
+
+# Sent as-is to refused clients, so refusing costs a single write
+REJECTIONS = {
+    "full": b"Server is full. Please try again later.\r\n",
+    "ip": b"Too many connections from your address.\r\n",
+    "subnet": b"Too many connections from your network.\r\n",
+    "rate": b"Server is busy. Please try again in a moment.\r\n",
+    "banned": b"You are banned from this server.\r\n",
+}
+
+
+def subnet_of(ip):
+    """Return the network an address is counted in."""
+    if ":" in ip:
+        return str(ipaddress.ip_network(f"{ip}/64", strict=False))
+    return ip.rpartition(".")[0] + ".0/24"
+
+
+class Admission:
+    """Decides whether a new connection may be served.
+
+    admit() is called by the accept loop before any other work is done
+    for the client; every admitted connection must be release()d once
+    it ends.
+    """
+
+    def __init__(
+        self,
+        max_connections,
+        per_ip=MAX_CONNECTIONS_PER_IP,
+        per_subnet=MAX_CONNECTIONS_PER_SUBNET,
+        accept_rate=ACCEPT_RATE,
+        bans=None,
+    ):
+        self.max_connections = max_connections
+        self.bans = bans  # BanList whose banned networks are turned away
+        self.per_ip = per_ip
+        self.per_subnet = per_subnet
+        self.bucket = TokenBucket(*accept_rate)
+        self.connections = 0
+        self.by_ip = {}  # {ip: connections}
+        self.by_subnet = {}  # {subnet: connections}
+        self.lock = threading.Lock()
+
+    def admit(self, ip):
+        """Count a new connection in; returns None, or why it is refused."""
+        if self.bans and self.bans.is_address_banned(ip):
+            return "banned"
+        subnet = subnet_of(ip)
+        with self.lock:
+            if self.connections >= self.max_connections:
+                reason = "full"
+            elif self.per_ip and self.by_ip.get(ip, 0) >= self.per_ip:
+                reason = "ip"
+            elif self.per_subnet and self.by_subnet.get(subnet, 0) >= self.per_subnet:
+                reason = "subnet"
+            elif not self.bucket.consume(time.monotonic()):
+                reason = "rate"
+            else:
+                self._count_in(ip, subnet)
+                return None
+        return reason
+
+    def adopt(self, ip):
+        """Count in a connection taken over from a previous server process,
+        whatever the limits."""
+        with self.lock:
+            self._count_in(ip, subnet_of(ip))
+
+    def _count_in(self, ip, subnet):
+        self.connections += 1
+        self.by_ip[ip] = self.by_ip.get(ip, 0) + 1
+        self.by_subnet[subnet] = self.by_subnet.get(subnet, 0) + 1
+
+    def release(self, ip):
+        """Count a connection out."""
+        subnet = subnet_of(ip)
+        with self.lock:
+            self.connections -= 1
+            for counts, key in ((self.by_ip, ip), (self.by_subnet, subnet)):
+                if counts[key] <= 1:
+                    del counts[key]
+                else:
+                    counts[key] -= 1
+
+
+def refuse(sock, reason):
+    """Send the rejection for reason and close, without ever blocking."""
+    sock.setblocking(False)
+    try:
+        sock.send(REJECTIONS[reason])
+    except OSError:
+        pass  # Full buffer or gone already, the close says enough
+    sock.close()
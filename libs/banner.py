@@ -1,17 +1,31 @@
-from pathlib import Path
+import os
+import time
+from libs.storage import DATA_DIR
+
+DEFAULT_BANNER = """
+/======================================\\
+|         Welcome to TCServer          |
+\\======================================/
+"""
+
+# Seconds between checks of the banner files' modification times
+BANNER_CHECK_INTERVAL = float(os.getenv("BANNER_CHECK_INTERVAL", "30"))
+
+# Variant name -> file; missing variants fall back to the default banner
+BANNER_FILES = {
+    "default": DATA_DIR / "banner.txt",
+    "40": DATA_DIR / "banner_40.txt",  # Terminals 40 columns wide or less
+    "petscii": DATA_DIR / "banner_petscii.txt",  # Raw PETSCII bytes for C64s
+}
 
 
 def load_banner():
     """Load and return the banner from file."""
-    banner_file = Path("data/banner.txt")
+    banner_file = BANNER_FILES["default"]
 
     if not banner_file.exists():
         # Return a simple default banner if file doesn't exist
-        return """
-/======================================\\
-|         Welcome to TCServer          |
-\\======================================/
-"""
+        return DEFAULT_BANNER
 
     try:
         with open(banner_file, "r") as f:
@@ -19,3 +33,63 @@ def load_banner():
     except:
         # Return simple banner if there's any error
         return "Welcome to TCServer\r\n"
+
+
+def _to_crlf(data):
+    """Normalize line endings to the CRLF telnet terminals expect."""
+    return data.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+class BannerCache:
+    """Pre-encoded banner variants, reloaded when their files change.
+
+    Files are only looked at every BANNER_CHECK_INTERVAL seconds or on
+    reload(), so sending the banner to a new client costs no file I/O.
+    """
+
+    def __init__(self, files=BANNER_FILES, check_interval=BANNER_CHECK_INTERVAL):
+        self.files = files
+        self.check_interval = check_interval
+        self.variants = {}  # {variant: bytes}
+        self.mtimes = {}  # {variant: mtime or None}
+        self.checked_at = 0
+        self.reload()
+
+    def reload(self):
+        """Read every banner file again."""
+        mtimes = {name: self._mtime(path) for name, path in self.files.items()}
+        variants = {}
+        for name, path in self.files.items():
+            if name == "default":
+                variants[name] = _to_crlf(load_banner().encode("ascii", "replace"))
+            elif mtimes[name] is not None:
+                data = path.read_bytes()
+                # PETSCII is sent byte for byte, it has its own line endings
+                variants[name] = data if name == "petscii" else _to_crlf(data)
+        self.mtimes, self.variants = mtimes, variants
+        self.checked_at = time.monotonic()
+
+    def _mtime(self, path):
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            return None
+
+    def _check(self):
+        """Reload if any banner file was added, changed or removed."""
+        self.checked_at = time.monotonic()
+        for name, path in self.files.items():
+            if self._mtime(path) != self.mtimes.get(name):
+                self.reload()
+                return
+
+    def get(self, width=None, petscii=False):
+        """Return the encoded banner best suited to a terminal."""
+        if time.monotonic() - self.checked_at >= self.check_interval:
+            self._check()
+        variants = self.variants
+        if petscii and "petscii" in variants:
+            return variants["petscii"]
+        if width and width <= 40 and "40" in variants:
+            return variants["40"]
+        return variants["default"]
@@ -0,0 +1,208 @@
+import ipaddress
+import math
+import re
+import threading
+import time
+
+FOREVER = math.inf  # Expiry of a permanent ban
+
+# "90s", "30m", "12h", "7d", "2w"; a bare number is seconds
+_DURATION = re.compile(r"(\d+)([smhdw]?)")
+_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(text):
+    """Return a duration such as "30m" in seconds, or None if invalid."""
+    match = _DURATION.fullmatch(text.lower())
+    if not match or not int(match.group(1)):
+        return None
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+def parse_network(text):
+    """Return the IP network an address or CIDR range stands for, or None."""
+    try:
+        return ipaddress.ip_network(text, strict=False)
+    except ValueError:
+        return None
+
+
+def parse_address(ip):
+    """Return an address, IPv4-mapped IPv6 addresses as plain IPv4."""
+    address = ipaddress.ip_address(ip)
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+def in_network(ip, network):
+    """Check if an address string is in an IP network."""
+    try:
+        return parse_address(ip) in network
+    except ValueError:
+        return False
+
+
+class NetworkTree:
+    """Binary prefix tree of the networks of one IP version.
+
+    Each bit of a network's prefix is one step down from the root, so a
+    lookup visits at most 32 (IPv6: 128) nodes however many networks are
+    stored. Nodes are [child for bit 0, child for bit 1, value] lists.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+
+    def _path(self, network, create=False):
+        node = self.root
+        path = [node]
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (address >> (self.bits - 1 - i)) & 1
+            child = node[bit]
+            if child is None:
+                if not create:
+                    return None
+                child = node[bit] = [None, None, None]
+            node = child
+            path.append(node)
+        return path
+
+    def insert(self, network, value):
+        self._path(network, create=True)[-1][2] = value
+
+    def remove(self, network):
+        path = self._path(network)
+        if path is None:
+            return
+        path[-1][2] = None
+        # Prune the nodes only the removed network needed
+        for depth in range(len(path) - 1, 0, -1):
+            node = path[depth]
+            if node[0] is not None or node[1] is not None or node[2] is not None:
+                break
+            parent = path[depth - 1]
+            if parent[0] is node:
+                parent[0] = None
+            else:
+                parent[1] = None
+
+    def lookup(self, address):
+        """Yield the values of the networks containing an address (an int)."""
+        node = self.root
+        shift = self.bits
+        while node is not None:
+            if node[2] is not None:
+                yield node[2]
+            shift -= 1
+            if shift < 0:
+                break
+            node = node[(address >> shift) & 1]
+
+
+class BanList:
+    """Banned usernames and IP networks, kept in storage.
+
+    Bans may expire; expired ones are ignored, and dropped the next time
+    the list is loaded or listed. Addresses are checked for every new
+    connection, through one NetworkTree per IP version.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.users = {}  # {username.lower(): expiry}
+        self.networks = {}  # {network: expiry}
+        self.trees = {}  # {IP version: NetworkTree}
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Load the bans from storage again.
+
+        The new lookup structures are built aside and swapped in, so
+        connections keep being checked meanwhile.
+        """
+        users, networks = {}, {}
+        trees = {4: NetworkTree(32), 6: NetworkTree(128)}
+        now = time.time()
+        with self.lock:
+            for kind, target, expires in self.storage.load_bans():
+                if expires is not None and expires <= now:
+                    self.storage.delete_ban(kind, target)
+                    continue
+                expiry = FOREVER if expires is None else expires
+                self._set(users, networks, trees, kind, target, expiry)
+            self.users, self.networks, self.trees = users, networks, trees
+
+    @staticmethod
+    def _set(users, networks, trees, kind, target, expiry):
+        if kind == "user":
+            users[target] = expiry
+        else:
+            network = ipaddress.ip_network(target)
+            networks[network] = expiry
+            trees[network.version].insert(network, expiry)
+
+    @staticmethod
+    def key(kind, target):
+        """Return the form a ban target is stored under."""
+        if kind == "user":
+            return target.lower()
+        return str(ipaddress.ip_network(target, strict=False))
+
+    def add(self, kind, target, expires=None):
+        """Ban a username ("user") or an IP network ("ip") until expires,
+        a time.time() value, or for good if None."""
+        target = self.key(kind, target)
+        with self.lock:
+            self.storage.upsert_ban(kind, target, expires)
+            expiry = FOREVER if expires is None else expires
+            self._set(self.users, self.networks, self.trees, kind, target, expiry)
+
+    def remove(self, kind, target):
+        """Lift a ban; returns False if there was none."""
+        target = self.key(kind, target)
+        with self.lock:
+            if kind == "user":
+                found = self.users.pop(target, None) is not None
+            else:
+                network = ipaddress.ip_network(target)
+                found = self.networks.pop(network, None) is not None
+                self.trees[network.version].remove(network)
+            if found:
+                self.storage.delete_ban(kind, target)
+            return found
+
+    def is_user_banned(self, username):
+        """Check if a username is banned."""
+        expiry = self.users.get(username.lower())
+        return expiry is not None and expiry > time.time()
+
+    def is_address_banned(self, ip):
+        """Check if an IP address is in a banned network."""
+        if not self.networks:
+            return False
+        try:
+            address = parse_address(ip)
+        except ValueError:
+            return False
+        now = time.time()
+        tree = self.trees[address.version]
+        return any(expiry > now for expiry in tree.lookup(int(address)))
+
+    def entries(self):
+        """Return the bans in force as sorted (kind, target, expires) tuples,
+        dropping the expired ones."""
+        now = time.time()
+        with self.lock:
+            bans = [("user", name, expiry) for name, expiry in self.users.items()]
+            bans += [("ip", str(net), expiry) for net, expiry in self.networks.items()]
+        entries = []
+        for kind, target, expiry in sorted(bans):
+            if expiry <= now:
+                self.remove(kind, target)
+            else:
+                entries.append((kind, target, None if expiry == FOREVER else expiry))
+        return entries
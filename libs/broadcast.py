@@ -1,30 +1,46 @@
+import time
+from libs.metrics import metrics
+
+
 def broadcast_message(
-    connections, message, sender_addr=None, room=None, system_msg=False
+    sessions, message, sender=None, room=None, system_msg=False, skip=()
 ):
-    """Broadcasts a message to all users in a room or system-wide."""
+    """Broadcasts a message to all users in a room or system-wide.
+
+    The message is wrapped and encoded once per charset and width in use
+    among the recipients and queued on each recipient's outbound queue,
+    so a slow client never holds up the sender. Sessions in skip are left
+    out, like the sender.
+    """
+    started = time.perf_counter()
     formatted_message = f"\r\n{message}\r\n"
-    encoded_message = formatted_message.encode("ascii")
+    encoded = {}  # {(Charset, width): bytes}
 
     # Get recipients based on room, unless it's a system message
-    recipients = (
-        connections.keys()
-        if system_msg
-        else (room.users if room else connections.keys())
-    )
+    recipients = sessions if system_msg or not room else room.users
 
     # Always show to console
     print(formatted_message)
 
-    # Send to other recipients
-    for addr in recipients:
-        if addr not in connections or addr == ("console", 0):
+    # Send to other recipients (copied, other threads may join or leave)
+    delivered = []
+    for session in tuple(recipients):
+        if session is sender or session.conn is None or session in skip:
             continue
+        key = (session.charset, session.wrap_width)
+        encoded_message = encoded.get(key)
+        if encoded_message is None:
+            encoded_message = encoded[key] = session.encode(formatted_message)
         try:
-            if sender_addr and addr == sender_addr:
-                continue
-            connections[addr].sendall(encoded_message)
+            session.conn.sendall(encoded_message)
+            delivered.append(session)
         except (ConnectionError, BrokenPipeError):
-            print(f"Error sending message to {addr}")
+            print(f"Error sending message to {session.addr}")
+            metrics.inc("tcserver_broadcast_failures_total")
         except:
             # If sending fails, we'll let the main loop handle the disconnection
-            pass
+            metrics.inc("tcserver_broadcast_failures_total")
+    metrics.inc("tcserver_broadcasts_total")
+    metrics.observe("tcserver_broadcast_recipients", len(delivered))
+    metrics.observe("tcserver_broadcast_seconds", time.perf_counter() - started)
+    return delivered
@@ -0,0 +1,124 @@
+import codecs
+import os
+import unicodedata
+from libs.wrap import wrap
+
+# Character set of new connections; clients can switch with /charset
+DEFAULT_CHARSET = os.getenv("DEFAULT_CHARSET", "ascii").lower()
+
+REPLACEMENT = "?"
+
+
+class _EncodeTable(dict):
+    """{code point: output} for str.translate, filled in on first use
+    for characters the charset lacks: accented letters lose their accent
+    if the base letter exists, anything else becomes a question mark."""
+
+    def __missing__(self, code_point):
+        base = unicodedata.normalize("NFKD", chr(code_point))
+        output = "".join(self.get(ord(char), "") for char in base)
+        if not output.strip():
+            output = REPLACEMENT
+        self[code_point] = output
+        return output
+
+
+class Charset:
+    """How text is turned into bytes for a client, and back.
+
+    Single-byte charsets go through precomputed 256-entry tables in both
+    directions, so encoding a message is one str.translate() call. With
+    no table, UTF-8 is used both ways.
+    """
+
+    def __init__(self, name, table=None, utf8_input=False, newline=None):
+        self.name = name
+        self.newline = newline  # Line ending sent for CRLF and LF alike
+        self._constants = {}  # {(text, width): bytes} for fixed messages
+        self._decode = None
+        self._encode = None
+        self.ascii_compatible = table is None or table[0x41] == "A"
+        if table is None:
+            return
+        if not utf8_input:
+            # Byte -> text; unlisted bytes are dropped
+            self._decode = dict(enumerate(table))
+        # Text -> byte as a latin-1 character; 0xFF is left out, it is the
+        # telnet IAC byte
+        self._encode = _EncodeTable()
+        for byte, char in reversed(list(enumerate(table))):
+            if len(char) == 1 and byte != 0xFF:
+                self._encode[ord(char)] = chr(byte)
+        if newline is not None:
+            self._encode[ord("\n")] = newline
+
+    def __repr__(self):
+        return f"<Charset {self.name}>"
+
+    def encode(self, text):
+        """Return text as bytes for the client."""
+        if self.ascii_compatible and text.isascii():
+            return text.encode("ascii")
+        if self._encode is None:
+            return text.encode("utf-8")
+        if self.newline is not None:
+            text = text.replace("\r\n", "\n")
+        return text.translate(self._encode).encode("latin-1")
+
+    def constant(self, text, width=0):
+        """Wrap and encode a message that never changes, cached."""
+        key = (text, width)
+        data = self._constants.get(key)
+        if data is None:
+            data = self._constants[key] = self.encode(wrap(text, width))
+        return data
+
+    def decoder(self):
+        """Return a function decoding the client's input chunk by chunk."""
+        if self._decode is None:
+            return codecs.getincrementaldecoder("utf-8")("replace").decode
+        table = self._decode
+        return lambda data: data.decode("latin-1").translate(table)
+
+
+def _petscii_table():
+    """PETSCII as sent by a C64 in upper/lower case mode."""
+    table = [""] * 256
+    for byte in range(0x20, 0x40):
+        table[byte] = chr(byte)  # Space, digits and punctuation
+    table[0x40] = "@"
+    for offset in range(26):
+        table[0x41 + offset] = chr(ord("a") + offset)
+        table[0xC1 + offset] = chr(ord("A") + offset)
+    table[0x5B], table[0x5C], table[0x5D] = "[", "£", "]"
+    table[0x5E], table[0x5F] = "↑", "←"
+    table[0x0D] = "\r"
+    table[0x14] = "\x08"  # INST/DEL deletes to the left
+    table[0x07] = "\x07"
+    return table
+
+
+def _ascii_table():
+    return [chr(byte) if byte < 0x80 else "" for byte in range(256)]
+
+
+CHARSETS = {
+    # ASCII clients get ASCII, but UTF-8 typed by modern clients is understood
+    "ascii": Charset("ascii", _ascii_table(), utf8_input=True),
+    "latin1": Charset("latin1", [chr(byte) for byte in range(256)]),
+    "utf8": Charset("utf8"),
+    "cp437": Charset("cp437", bytes(range(256)).decode("cp437")),
+    # A C64 starts a new line on carriage return alone
+    "petscii": Charset("petscii", _petscii_table(), newline="\r"),
+}
+ALIASES = {"us-ascii": "ascii", "latin-1": "latin1", "iso-8859-1": "latin1"}
+ALIASES.update({"utf-8": "utf8", "ibm437": "cp437", "c64": "petscii"})
+
+
+def get_charset(name):
+    """Return the charset with the given name or alias, or None."""
+    name = name.lower()
+    return CHARSETS.get(ALIASES.get(name, name))
+
+
+default_charset = get_charset(DEFAULT_CHARSET) or CHARSETS["ascii"]
@@ -0,0 +1,219 @@
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+from libs.connection import SocketConnection
+
+# Name of this node, shown next to its users in /users on the other nodes
+CLUSTER_NODE = os.getenv("CLUSTER_NODE", socket.gethostname())
+# Port the other nodes connect to; 0 disables clustering
+CLUSTER_PORT = int(os.getenv("CLUSTER_PORT", "0"))
+# Other nodes, as comma separated host:port backbone addresses
+CLUSTER_PEERS = os.getenv("CLUSTER_PEERS", "")
+# Shared secret every node must present; without one the backbone only
+# listens on 127.0.0.1
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+# Seconds between heartbeats; a link silent for 3 heartbeats is dropped
+CLUSTER_HEARTBEAT = float(os.getenv("CLUSTER_HEARTBEAT", "5"))
+# Longest wait between attempts to reach a peer that is down
+CLUSTER_RECONNECT_MAX = float(os.getenv("CLUSTER_RECONNECT_MAX", "30"))
+# Events that may wait for a slow peer; senders then wait for room, since
+# an event lost on one link leaves the nodes disagreeing
+CLUSTER_QUEUE_SIZE = int(os.getenv("CLUSTER_QUEUE_SIZE", "65536"))
+
+MAX_FRAME = 1024 * 1024
+
+
+def parse_peers(peers):
+    """Parse "host:port,host:port" into a list of addresses."""
+    addresses = []
+    for peer in peers.split(","):
+        if peer.strip():
+            host, _, port = peer.strip().rpartition(":")
+            addresses.append((host, int(port)))
+    return addresses
+
+
+def _frame(message):
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+class Cluster:
+    """Links to the other nodes of a cluster over TCP.
+
+    Every node dials every peer and sends its own events down that link,
+    so events from a peer arrive on the link the peer dialed and nothing
+    needs to be forwarded. Messages are JSON lines. The dialing side
+    sends heartbeats, the other side answers them, and either side drops
+    a link that stays silent; dropped links are dialed again with backoff.
+    """
+
+    def __init__(
+        self,
+        node=CLUSTER_NODE,
+        port=CLUSTER_PORT,
+        peers=CLUSTER_PEERS,
+        secret=CLUSTER_SECRET,
+        heartbeat=CLUSTER_HEARTBEAT,
+    ):
+        self.node = node
+        self.port = port
+        self.peers = parse_peers(peers)
+        self.secret = secret
+        self.heartbeat = heartbeat
+        self.timeout = 3 * heartbeat
+        self.outbound = {}  # {peer address: SocketConnection}
+        self.inbound = {}  # {node: socket}
+        self.presence = None  # Last presence frame, sent to new links
+        self.lock = threading.Lock()
+
+    def publish(self, kind, *args):
+        """Send an event to every connected node."""
+        frame = _frame({"type": "event", "kind": kind, "args": args})
+        with self.lock:
+            if kind == "presence":
+                self.presence = frame
+            links = list(self.outbound.values())
+        for link in links:
+            link.sendall(frame)
+
+    def start(self, handlers, dispatch=None):
+        """Listen for peers and dial them.
+
+        Events are passed to handlers[kind](*args), through
+        dispatch(handler, *args) when one is given. When a node's link
+        drops, handlers["presence"] is called to forget its users.
+        """
+        self.handlers = handlers
+        self.dispatch = dispatch
+        # Without a secret anyone reaching the port could inject events
+        host = "0.0.0.0" if self.secret else "127.0.0.1"
+        self._thread(self._accept_loop, host)
+        for address in self.peers:
+            self._thread(self._dial_loop, address)
+        print(f"[CLUSTER] Node {self.node} on backbone port {host}:{self.port}")
+        if not self.secret:
+            print("[CLUSTER] Warning: no CLUSTER_SECRET set, other hosts can't link")
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _handle(self, kind, args):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            return
+        if self.dispatch:
+            self.dispatch(handler, *args)
+        else:
+            handler(*args)
+
+    def _dial_loop(self, address):
+        delay = 1
+        while True:
+            try:
+                sock = socket.create_connection(address, timeout=self.heartbeat)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, CLUSTER_RECONNECT_MAX)
+                continue
+            sock.settimeout(None)
+            delay = 1
+            link = SocketConnection(
+                sock,
+                maxlen=CLUSTER_QUEUE_SIZE,
+                block_timeout=self.timeout,
+            )
+            hello = {"type": "hello", "node": self.node, "secret": self.secret}
+            with self.lock:
+                link.sendall(_frame(hello))
+                if self.presence:
+                    link.sendall(self.presence)
+                self.outbound[address] = link
+            print(f"[CLUSTER] Linked to {address[0]}:{address[1]}")
+            self._heartbeat_loop(link)
+            with self.lock:
+                del self.outbound[address]
+            link.close()
+            print(f"[CLUSTER] Lost link to {address[0]}:{address[1]}")
+
+    def _heartbeat_loop(self, link):
+        """Ping the peer until it stops answering."""
+        ping = _frame({"type": "ping"})
+        last_seen = next_ping = time.monotonic()
+        while not link.closing:
+            now = time.monotonic()
+            if now >= next_ping:
+                link.sendall(ping)
+                next_ping = now + self.heartbeat
+            if now - last_seen > self.timeout:
+                return
+            try:
+                if link.wait_readable(next_ping - now):
+                    if not link.recv(4096):
+                        return
+                    last_seen = time.monotonic()  # Pongs, contents don't matter
+            except (OSError, ValueError):
+                return
+
+    def _accept_loop(self, host):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, self.port))
+            server.listen()
+            while True:
+                sock, addr = server.accept()
+                self._thread(self._receive_loop, sock, addr)
+
+    def _receive_loop(self, sock, addr):
+        """Handle the events a peer sends down the link it dialed."""
+        node = None
+        sock.settimeout(self.timeout)
+        buffer = b""
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                if len(buffer) > MAX_FRAME:
+                    break
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    message = json.loads(line)
+                    if node is None:
+                        node = self._greet(message, sock, addr)
+                        if node is None:
+                            return
+                    elif message["type"] == "ping":
+                        sock.sendall(b"pong\n")
+                    elif message["type"] == "event":
+                        self._handle(message["kind"], message["args"])
+        except (OSError, ValueError, KeyError):
+            pass  # Timed out, dropped, or garbage
+        finally:
+            sock.close()
+            with self.lock:
+                # A node that reconnected already replaced this link
+                current = node is not None and self.inbound.get(node) is sock
+                if current:
+                    del self.inbound[node]
+            if current:
+                self._handle("presence", (f"node {node}", {}))
+                print(f"[CLUSTER] Node {node} disconnected")
+
+    def _greet(self, message, sock, addr):
+        """Check a peer's hello; returns its node name, or None."""
+        if message.get("type") != "hello" or not hmac.compare_digest(
+            str(message.get("secret")).encode(), self.secret.encode()
+        ):
+            print(f"[CLUSTER] Refused link from {addr[0]}")
+            return None
+        node = str(message["node"])
+        with self.lock:
+            self.inbound[node] = sock
+        print(f"[CLUSTER] Node {node} connected from {addr[0]}")
+        return node
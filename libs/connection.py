@@ -0,0 +1,234 @@
+import asyncio
+import os
+import select
+import selectors
+import socket
+import threading
+from collections import deque
+
+# Frames a client may have waiting before the overflow policy kicks in
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+# What to do when a client's queue is full: drop_oldest, drop_newest or disconnect
+OVERFLOW_POLICY = os.getenv("OVERFLOW_POLICY", "drop_oldest").lower()
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+# Policy of links that must not lose anything (the cluster backbone): the
+# sender waits for room instead, see SocketConnection.sendall()
+BLOCK = "block"
+
+# Server-wide counters, summed over every connection ever opened
+queue_stats = {"dropped": 0, "disconnected": 0}
+
+
+def enable_keepalive(sock, idle):
+    """Turn on TCP keepalive probes after idle seconds of silence."""
+    if not idle:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):  # Linux; other systems keep defaults
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client.
+
+    Producers (broadcasts, command replies) only ever append to the queue;
+    a per-connection writer drains it, so a slow client can never stall
+    the sender or the rest of the room.
+    """
+
+    def __init__(self, maxlen=OUTBOUND_QUEUE_SIZE, policy=OVERFLOW_POLICY):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.frames = deque()
+        self.maxlen = maxlen
+        self.policy = policy
+        self.dropped = 0  # Frames discarded by the overflow policy
+        self.closing = False  # No more frames accepted, flush and close
+        self.aborted = False  # Close immediately, discarding queued frames
+        self.writing = False  # A batch is being written out
+
+    @property
+    def depth(self):
+        """Number of frames waiting to be written."""
+        return len(self.frames)
+
+    def _enqueue(self, data):
+        """Append a frame, applying the overflow policy.
+
+        Returns True if the writer needs to be woken up.
+        """
+        if self.closing:
+            return False
+        if len(self.frames) >= self.maxlen and self.policy != BLOCK:
+            if self.policy == "disconnect":
+                self.frames.clear()
+                self.closing = self.aborted = True
+                queue_stats["disconnected"] += 1
+                return True
+            self.dropped += 1
+            queue_stats["dropped"] += 1
+            if self.policy == "drop_newest":
+                return False
+            self.frames.popleft()
+        self.frames.append(data)
+        return True
+
+    @property
+    def flushed(self):
+        """True when everything queued has been written out."""
+        return not self.frames and not self.writing
+
+    def _take_batch(self):
+        """Remove all queued frames and return them as a single write."""
+        batch = b"".join(self.frames)
+        self.frames.clear()
+        return batch
+
+    def take_unsent(self):
+        """Remove and return the frames not written yet, for a new process
+        taking the connection over to send."""
+        return self._take_batch()
+
+
+class SocketConnection(OutboundQueue):
+    """Blocking socket with an outbound queue drained by a writer thread.
+
+    Given a block_timeout, the BLOCK policy applies: sendall() waits
+    while the queue is full, and gives up on the link if the writer makes
+    no progress for block_timeout seconds.
+    """
+
+    def __init__(self, sock, block_timeout=None, **kwargs):
+        super().__init__(**kwargs)
+        self.sock = sock
+        self.block_timeout = block_timeout
+        if block_timeout is not None:
+            self.policy = BLOCK
+        self._poll = None
+        self._ready = threading.Condition()
+        self._writer = threading.Thread(target=self._drain_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wait_readable(self, timeout=None):
+        """Wait up to timeout seconds (None: for ever) for input, without
+        touching the socket's own timeout (which the writer thread relies on)."""
+        if not hasattr(select, "poll"):
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.sock, selectors.EVENT_READ)
+                return bool(selector.select(timeout))
+        if self._poll is None:
+            self._poll = select.poll()
+            self._poll.register(self.sock, select.POLLIN)
+        return bool(self._poll.poll(None if timeout is None else timeout * 1000))
+
+    def sendall(self, data):
+        """Queue data for the writer thread without blocking."""
+        with self._ready:
+            if self.policy == BLOCK:
+                self._wait_for_room()
+            if self._enqueue(data):
+                self._ready.notify_all()
+        if self.aborted:
+            self._shutdown()  # Unblock a writer stuck on the slow client
+
+    def _wait_for_room(self):
+        while len(self.frames) >= self.maxlen and not self.closing:
+            if not self._ready.wait(self.block_timeout):
+                self.frames.clear()  # Stuck: drop the link, not single frames
+                self.closing = self.aborted = True
+
+    def close(self):
+        """Flush queued frames, then close the socket."""
+        with self._ready:
+            self.closing = True
+            self._ready.notify_all()
+
+    def _shutdown(self):
+        try:
+            # Also wakes up the reader thread blocked in recv()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _drain_loop(self):
+        while True:
+            with self._ready:
+                while not self.frames and not self.closing:
+                    self._ready.wait()
+                if self.aborted or not self.frames:
+                    break
+                batch = self._take_batch()
+                self.writing = True
+                self._ready.notify_all()  # Room again for BLOCK senders
+            try:
+                self.sock.sendall(batch)
+            except OSError:
+                break
+            finally:
+                self.writing = False
+        self._shutdown()
+        self.sock.close()
+
+
+class StreamConnection(OutboundQueue):
+    """Socket-like wrapper around an asyncio StreamWriter.
+
+    Exposes the same sendall/close interface as SocketConnection so the
+    line processing and broadcast code can serve both server modes.
+    Must be created and fed from the event loop thread.
+    """
+
+    def __init__(self, writer, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer
+        self._ready = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._drain_loop())
+
+    @property
+    def flushed(self):
+        return not self.frames and not self.writer.transport.get_write_buffer_size()
+
+    def fileno(self):
+        return self.writer.get_extra_info("socket").fileno()
+
+    def sendall(self, data):
+        """Queue data for the writer task without blocking the event loop."""
+        if self._enqueue(data):
+            self._ready.set()
+        if self.aborted:
+            # The writer task may be stuck draining to the slow client
+            self.writer.transport.abort()
+
+    def close(self):
+        """Flush queued frames, then close the stream."""
+        self.closing = True
+        self._ready.set()
+
+    async def _drain_loop(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                if self.aborted:
+                    self.writer.transport.abort()
+                    return
+                if self.frames:
+                    self.writer.write(self._take_batch())
+                    await self.writer.drain()
+                elif self.closing:
+                    break
+                if self.closing:
+                    self._ready.set()  # Come back round to flush or finish
+        except (ConnectionError, RuntimeError):
+            pass
+        self.writer.close()
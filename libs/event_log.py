@@ -0,0 +1,107 @@
+import atexit
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+# Also log chat messages and commands (to logs/chat_<date>.log)
+LOG_CHAT = os.getenv("LOG_CHAT", "0") == "1"
+# Entries kept in memory while the disk is slow; the oldest are dropped first
+LOG_BACKLOG = int(os.getenv("LOG_BACKLOG", "10000"))
+# Write out after this many seconds, or once this many bytes are waiting
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_FLUSH_BYTES = int(os.getenv("LOG_FLUSH_BYTES", "65536"))
+
+
+class EventLog:
+    """Log files written by a background thread.
+
+    log() only appends to a bounded in-memory backlog, so a slow disk
+    never blocks a client connection. The writer thread keeps one file
+    per stream and day open and writes the backlog out in batches.
+    """
+
+    def __init__(
+        self,
+        log_dir=LOG_DIR,
+        backlog=LOG_BACKLOG,
+        flush_interval=LOG_FLUSH_INTERVAL,
+        flush_bytes=LOG_FLUSH_BYTES,
+    ):
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.entries = deque(maxlen=backlog)  # (stream, date, line)
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.files = {}  # {stream: (date, file)}
+        self.ready = threading.Condition()
+        self.running = True
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def log(self, stream, line):
+        """Queue a line for logs/<stream>_<date>.log."""
+        now = datetime.now()
+        entry = (
+            stream,
+            now.strftime("%Y-%m-%d"),
+            f"[{now.strftime('%Y-%m-%d %H:%M:%S')}] {line}\n",
+        )
+        with self.ready:
+            if len(self.entries) == self.entries.maxlen:
+                self.dropped += 1
+                self.pending_bytes -= len(self.entries[0][2])
+            self.entries.append(entry)
+            self.pending_bytes += len(entry[2])
+            if self.pending_bytes >= self.flush_bytes:
+                self.ready.notify()
+
+    def _write_loop(self):
+        while self.running:
+            with self.ready:
+                self.ready.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write every queued entry to its file."""
+        with self.ready:
+            entries = list(self.entries)
+            self.entries.clear()
+            self.pending_bytes = 0
+        if not entries:
+            return
+        touched = set()
+        for stream, date, line in entries:
+            self._file(stream, date).write(line)
+            touched.add(stream)
+        for stream in touched:
+            self.files[stream][1].flush()
+
+    def _file(self, stream, date):
+        """Open file for a stream, rotated when the date changes."""
+        current = self.files.get(stream)
+        if current and current[0] == date:
+            return current[1]
+        if current:
+            current[1].close()
+        os.makedirs(self.log_dir, exist_ok=True)
+        f = open(
+            os.path.join(self.log_dir, f"{stream}_{date}.log"), "a", encoding="utf-8"
+        )
+        self.files[stream] = (date, f)
+        return f
+
+    def close(self):
+        """Flush what is left and close the files."""
+        self.running = False
+        with self.ready:
+            self.ready.notify()
+        self.writer.join(timeout=self.flush_interval + 1)
+        self.flush()
+        for _, f in self.files.values():
+            f.close()
+        self.files.clear()
@@ -0,0 +1,203 @@
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from libs.storage import DATA_DIR
+
+# Unix socket a restarting server hands its connections over on
+HANDOFF_SOCKET = os.getenv("HANDOFF_SOCKET", str(DATA_DIR / "handoff.sock"))
+# Seconds the new process gets to start up and take over, after which the
+# restart is abandoned and the old process carries on
+HANDOFF_TIMEOUT = float(os.getenv("HANDOFF_TIMEOUT", "30"))
+# Seconds to let queued output reach clients before handing them over;
+# whatever is still queued then is passed along for the new process to send
+HANDOFF_FLUSH = float(os.getenv("HANDOFF_FLUSH", "2.0"))
+
+# Set in the environment of the new process, to the socket to connect to
+HANDOFF_ENV = "TCSERVER_HANDOFF"
+# Descriptors passed per message, below the kernel's limit (SCM_MAX_FD)
+FDS_PER_MESSAGE = 200
+
+
+def send_message(sock, message, fds=()):
+    """Send a JSON message, with file descriptors attached."""
+    # The descriptors ride on a one-byte write of their own, so the reader
+    # finds them on the first byte of the message
+    if fds:
+        socket.send_fds(sock, [b"M"], list(fds))
+    else:
+        sock.sendall(b"M")
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def recv_message(sock):
+    """Receive a message sent by send_message(); returns (message, fds)."""
+    marker, fds, flags, _ = socket.recv_fds(sock, 1, FDS_PER_MESSAGE)
+    if not marker:
+        raise EOFError("handoff link closed")
+    if flags & socket.MSG_CTRUNC:
+        for fd in fds:
+            os.close(fd)
+        raise OSError("file descriptors were truncated")
+    (size,) = struct.unpack("!I", _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, size)), fds
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("handoff link closed")
+        data += chunk
+    return bytes(data)
+
+
+class Gate:
+    """Lets connection handlers run until a handoff closes it.
+
+    Code that reads from clients or changes sessions runs inside
+    `with gate:`. close() waits until nobody is inside and holds back
+    everyone else, so the state being handed over stays put; open() lets
+    them carry on if the handoff fails. Not reentrant.
+    """
+
+    def __init__(self):
+        self.inside = 0
+        self.closed = False
+        self.changed = threading.Condition()
+
+    def __enter__(self):
+        with self.changed:
+            while self.closed:
+                self.changed.wait()
+            self.inside += 1
+
+    def __exit__(self, *exc_info):
+        with self.changed:
+            self.inside -= 1
+            if not self.inside:
+                self.changed.notify_all()
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            while self.inside:
+                self.changed.wait()
+
+    def open(self):
+        with self.changed:
+            self.closed = False
+            self.changed.notify_all()
+
+
+class Handoff:
+    """Hands this server's sockets over to a new server process.
+
+    spawn() starts the new process, which connects back over a Unix
+    socket; send() then passes it the listening socket and every client
+    socket (SCM_RIGHTS), along with the state of their sessions. The
+    clients never notice: their TCP connections stay open throughout.
+    """
+
+    def __init__(self, environ, path=HANDOFF_SOCKET, timeout=HANDOFF_TIMEOUT):
+        self.environ = environ  # Environment the new process starts with
+        self.path = path
+        self.timeout = timeout
+        self.process = None
+        self.link = None
+
+    def spawn(self):
+        """Start the new process and wait until it is ready to take over."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self.path)
+            server.listen(1)
+            server.settimeout(0.5)
+            env = dict(self.environ, **{HANDOFF_ENV: self.path})
+            self.process = subprocess.Popen([sys.executable, *sys.argv], env=env)
+            deadline = time.monotonic() + self.timeout
+            while self.link is None:
+                try:
+                    self.link, _ = server.accept()
+                except socket.timeout:
+                    if self.process.poll() is not None:
+                        raise ChildProcessError("new server process exited")
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("new server process did not connect")
+        self.link.settimeout(self.timeout)
+        recv_message(self.link)  # Ready
+
+    def send(self, listener, sessions, history):
+        """Pass the listening socket and the (state, fd) of every session,
+        then wait for the new process to confirm it has taken over."""
+        send_message(self.link, {"kind": "listener"}, [listener])
+        for start in range(0, len(sessions), FDS_PER_MESSAGE):
+            batch = sessions[start : start + FDS_PER_MESSAGE]
+            send_message(
+                self.link,
+                {"kind": "sessions", "sessions": [state for state, _ in batch]},
+                [fd for _, fd in batch],
+            )
+        send_message(self.link, {"kind": "history", "rooms": history})
+        send_message(self.link, {"kind": "end"})
+        reply, _ = recv_message(self.link)
+        if reply.get("kind") != "ok":
+            raise EOFError("handoff not confirmed")
+
+    def abort(self):
+        """Give up on the new process."""
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.link:
+            self.link.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def take_over(path, timeout=HANDOFF_TIMEOUT):
+    """Receive the sockets of the server process being replaced.
+
+    Returns (listener, [(state, socket)], history) once the old process
+    has exited and let go of its other ports.
+    """
+    link = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    link.settimeout(timeout)
+    link.connect(path)
+    send_message(link, {"kind": "ready", "pid": os.getpid()})
+    listener, sessions, history = None, [], {}
+    while True:
+        message, fds = recv_message(link)
+        kind = message["kind"]
+        if kind == "listener":
+            listener = socket.socket(fileno=fds[0])
+        elif kind == "sessions":
+            socks = [socket.socket(fileno=fd) for fd in fds]
+            sessions.extend(zip(message["sessions"], socks))
+        elif kind == "history":
+            history = message["rooms"]
+        elif kind == "end":
+            break
+    send_message(link, {"kind": "ok"})
+    # The old process exits as soon as it reads that
+    try:
+        link.recv(1)
+    except OSError:
+        pass
+    link.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return listener, sessions, history
@@ -0,0 +1,167 @@
+import math
+import os
+import threading
+import time
+from libs.telnet import IAC, NOP, TELNET_NEGOTIATION
+
+# Seconds without input before a client is disconnected; 0 never disconnects
+IDLE_TIMEOUT_GUEST = float(os.getenv("IDLE_TIMEOUT_GUEST", "600"))
+IDLE_TIMEOUT_USER = float(os.getenv("IDLE_TIMEOUT_USER", "3600"))
+# Clients are warned this many seconds before being disconnected
+IDLE_WARNING = float(os.getenv("IDLE_WARNING", "60"))
+# Idle clients get a telnet NOP this often, so dead links fail a write;
+# also the TCP keepalive idle time. 0 disables both
+KEEPALIVE_INTERVAL = float(os.getenv("KEEPALIVE_INTERVAL", "120"))
+# Resolution of the timer wheel, in seconds
+IDLE_TICK = float(os.getenv("IDLE_TICK", "1"))
+
+TELNET_NOP = bytes((IAC, NOP))
+
+
+class TimerWheel:
+    """Hashed timer wheel.
+
+    Scheduling and firing are O(1) per timer: each tick only looks at
+    the timers in one slot. Timers further out than one turn of the
+    wheel wait in their slot for the remaining number of turns.
+
+    A timer set for exactly one turn fires on that turn's last tick:
+
+    >>> wheel = TimerWheel(tick=1, slots=8)
+    >>> wheel.schedule(8, "due")
+    >>> [i for i in range(1, 20) if wheel.advance()]
+    [8]
+    """
+
+    def __init__(self, tick=IDLE_TICK, slots=4096):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, item):
+        """Return item from advance() once delay seconds have passed."""
+        ticks = max(1, math.ceil(delay / self.tick))
+        # Counted from the next slot, so a timer a whole number of turns
+        # away doesn't land on the current slot and wait one turn too many
+        turns, offset = divmod(ticks - 1, len(self.slots))
+        with self.lock:
+            slot = (self.position + offset + 1) % len(self.slots)
+            self.slots[slot].append([turns, item])
+
+    def advance(self):
+        """Move on by one tick; returns the items that are due."""
+        with self.lock:
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            due = [item for turns, item in slot if turns == 0]
+            waiting = [entry for entry in slot if entry[0] > 0]
+            for entry in waiting:
+                entry[0] -= 1
+            self.slots[self.position] = waiting
+        return due
+
+
+class IdleReaper:
+    """Warns and then disconnects clients that stopped typing.
+
+    Each session has a single timer on the wheel, set for the next time
+    something could happen to it (a keepalive probe, the warning or the
+    disconnect). Input only updates session.last_active; when the timer
+    fires the session is checked and its timer set again, so a tick
+    costs nothing for clients whose timers aren't due.
+    """
+
+    def __init__(
+        self,
+        is_connected,
+        guest_timeout=IDLE_TIMEOUT_GUEST,
+        user_timeout=IDLE_TIMEOUT_USER,
+        warning=IDLE_WARNING,
+        keepalive=KEEPALIVE_INTERVAL,
+        wheel=None,
+    ):
+        self.is_connected = is_connected  # is_connected(session) -> bool
+        self.guest_timeout = guest_timeout
+        self.user_timeout = user_timeout
+        self.warning = warning
+        self.keepalive = keepalive
+        self.wheel = wheel or TimerWheel()
+        self.reaped = 0
+
+    def watch(self, session, idle=0):
+        """Start tracking a session, idle for that many seconds so far."""
+        session.last_active = time.monotonic() - idle
+        self._schedule(session, idle)
+
+    def _timeout(self, session):
+        return self.guest_timeout if session.role == "guest" else self.user_timeout
+
+    def _schedule(self, session, idle):
+        """Set the session's timer for the next thing that may happen."""
+        timeout = self._timeout(session)
+        delays = []
+        if timeout:
+            delays.append(timeout - idle)
+            if self.warning and not session.idle_warned:
+                delays.append(timeout - self.warning - idle)
+        if self.keepalive:
+            delays.append(self.keepalive - idle % self.keepalive)
+        delays = [delay for delay in delays if delay > 0]
+        if delays:
+            self.wheel.schedule(min(delays), session)
+
+    def tick(self):
+        """Handle the sessions whose timers are due."""
+        now = time.monotonic()
+        for session in self.wheel.advance():
+            if not self.is_connected(session):
+                continue  # Gone; its timer is simply not set again
+            conn = session.conn
+            idle = now - session.last_active
+            timeout = self._timeout(session)
+            if timeout and idle >= timeout:
+                self.reaped += 1
+                conn.sendall(session.constant("\r\n* Disconnected for inactivity.\r\n"))
+                conn.close()
+                continue
+            if idle < timeout - self.warning:
+                session.idle_warned = False  # Typed something since the warning
+            elif self.warning and timeout and not session.idle_warned:
+                session.idle_warned = True
+                conn.sendall(
+                    session.encode(
+                        f"\r\n* You will be disconnected in {int(timeout - idle)} "
+                        "seconds unless you type something.\r\n"
+                    )
+                )
+            if self.keepalive and idle >= self.keepalive and TELNET_NEGOTIATION:
+                conn.sendall(TELNET_NOP)
+            self._schedule(session, idle)
+
+    def start(self, loop=None, gate=None):
+        """Tick from a background thread, or on the given event loop.
+
+        A background thread ticks inside gate, when given (see Gate).
+        """
+        if loop:
+
+            def tick_on_loop():
+                self.tick()
+                loop.call_later(self.wheel.tick, tick_on_loop)
+
+            loop.call_later(self.wheel.tick, tick_on_loop)
+            return
+
+        def tick_forever():
+            while True:
+                time.sleep(self.wheel.tick)
+                if gate is None:
+                    self.tick()
+                    continue
+                with gate:
+                    self.tick()
+
+        thread = threading.Thread(target=tick_forever)
+        thread.daemon = True
+        thread.start()
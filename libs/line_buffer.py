@@ -0,0 +1,59 @@
+import os
+import re
+
+# Longest line a client may type; further characters are ignored
+MAX_LINE_LENGTH = int(os.getenv("MAX_LINE_LENGTH", "1024"))
+
+# Control characters except backspace/delete, TAB and line endings
+_IGNORED = dict.fromkeys(
+    c for c in [*range(32), *range(0x80, 0xA0)] if chr(c) not in "\x08\t\r\n"
+)
+# Runs of printable characters are handled in one step, controls one at a time
+_TOKENS = re.compile(r"[^\x00-\x1f\x7f-\x9f]+|[\x08\x7f]|[\r\n]|\t")
+
+ERASE = "\x08 \x08"  # Backspace, space, backspace clears one character
+
+
+class LineBuffer:
+    """Line being typed by a character-mode client, as decoded text."""
+
+    def __init__(self):
+        self.line = ""
+
+    def feed(self, text, complete=None):
+        """Apply a received chunk to the line being edited.
+
+        Returns (echo, lines): the text to echo back in a single write and
+        every line completed by a CR or LF within the chunk. TAB calls
+        complete(line), which returns (extension, matches) for the line so
+        far; without it TAB is ignored.
+        """
+        echo = []
+        lines = []
+        line = self.line
+        for match in _TOKENS.finditer(text.translate(_IGNORED)):
+            token = match.group()
+            if token in "\r\n":
+                if line:
+                    lines.append(line)
+                    line = ""
+            elif token in "\x08\x7f":
+                if line:
+                    line = line[:-1]
+                    echo.append(ERASE)
+            elif token == "\t":
+                if complete is None:
+                    continue
+                extension, matches = complete(line)
+                extension = extension[: MAX_LINE_LENGTH - len(line)]
+                line += extension
+                echo.append(extension)
+                if not extension and len(matches) > 1:
+                    # Show the choices, then the line again below them
+                    echo.append(f"\r\n{'  '.join(matches)}\r\n{line}")
+            else:
+                token = token[: MAX_LINE_LENGTH - len(line)]
+                line += token
+                echo.append(token)
+        self.line = line
+        return "".join(echo), lines
@@ -0,0 +1,79 @@
+import os
+import re
+import time
+
+# Offline messages kept per user until they next log in
+MAILBOX_SIZE = int(os.getenv("MAILBOX_SIZE", "20"))
+
+BELL = "\x07"
+# "@name" at the start of a word, trailing punctuation left out
+_MENTION = re.compile(r"(?:^|\s)@(\w+)")
+
+
+class Messenger:
+    """Private messages and mentions.
+
+    Both go straight to the recipient's sessions through the username
+    index, whatever room they are in. Messages for registered users who
+    are offline wait in their mailbox.
+    """
+
+    def __init__(self, user_manager, storage, mailbox_size=MAILBOX_SIZE):
+        self.user_manager = user_manager
+        self.storage = storage
+        self.mailbox_size = mailbox_size
+
+    def deliver(self, username, message):
+        """Send a message to every session of a user logged in here.
+
+        Returns the number of sessions reached.
+        """
+        message = f"\r\n{message}\r\n"
+        reached = 0
+        for session in tuple(self.user_manager.find_sessions(username)):
+            if session.conn:
+                session.conn.sendall(session.encode(message))
+                reached += 1
+        return reached
+
+    def send(self, sender, recipient, text):
+        """Send a private message; returns the reply for the sender."""
+        message = f"[DM from {sender}]: {text}"
+        if self.user_manager.is_online(recipient):
+            self.deliver(recipient, message)
+        elif self.user_manager.is_online_elsewhere(recipient):
+            self.user_manager.publish("msg", recipient, message)
+        elif self.user_manager.get_user(recipient):
+            mail = {"sender": sender, "text": text, "sent": time.time()}
+            if not self.storage.add_mail(recipient, mail, self.mailbox_size):
+                return f"The mailbox of {recipient} is full"
+            return f"{recipient} is offline, the message will be delivered on login"
+        else:
+            return "User not found"
+        return f"[DM to {recipient}]: {text}"
+
+    def take_mail(self, username):
+        """Return the lines of a user's offline messages, emptying the mailbox."""
+        return [
+            f"[DM from {mail['sender']}, "
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(mail['sent']))}]: "
+            f"{mail['text']}"
+            for mail in self.storage.take_mail(username)
+        ]
+
+    def mentioned(self, message, sender=None):
+        """Return the sessions here of the users "@mentioned" in a message."""
+        sessions = set()
+        if "@" not in message:
+            return sessions
+        for name in _MENTION.findall(message):
+            sessions.update(self.user_manager.find_sessions(name))
+        sessions.discard(sender)
+        return sessions
+
+    def highlight(self, sessions, message):
+        """Send a message to mentioned sessions, with a bell and a marker."""
+        message = f"\r\n{BELL}>> {message}\r\n"
+        for session in sessions:
+            if session.conn:
+                session.conn.sendall(session.encode(message))
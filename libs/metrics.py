@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Set to 0 to turn every counter and histogram into a no-op
+METRICS = os.getenv("METRICS", "1") == "1"
+# Local port serving /metrics in Prometheus text format; 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+# Histograms not listed here measure seconds
+HISTOGRAM_BUCKETS = {"tcserver_broadcast_recipients": SIZE_BUCKETS}
+
+
+class _Shard:
+    """Counters and histograms updated by a single thread."""
+
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = {}  # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): [bucket counts..., +Inf, sum]}
+
+
+class Metrics:
+    """Counters and histograms kept per thread.
+
+    Each thread only ever writes to its own shard, so recording is a
+    plain dict update with no lock. Shards are summed when the metrics
+    are read; those of finished threads are folded into a retired total.
+    Labels are passed preformatted, e.g. 'command="help"'.
+    """
+
+    def __init__(self, enabled=METRICS):
+        self.enabled = enabled
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards = []  # [(thread, _Shard)]
+        self._retired = _Shard()
+        self._prune_at = 64  # Shard count at which finished threads are retired
+        self._collectors = {}  # {name: (kind, fn)}, read when collecting
+        self._lock = threading.Lock()  # Guards the shard list only
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                # Keep the list bounded between snapshots, amortized O(1)
+                if len(self._shards) >= self._prune_at:
+                    self._retire_finished()
+                    self._prune_at = max(64, 2 * len(self._shards))
+            return shard
+
+    def _retire_finished(self):
+        """Fold the shards of finished threads into the retired total.
+
+        Called with the lock held.
+        """
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                _merge(self._retired, shard.counters, shard.histograms)
+        self._shards = live
+
+    def inc(self, name, amount=1, labels=""):
+        """Add to a counter."""
+        if not self.enabled:
+            return
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=""):
+        """Record a value in a histogram."""
+        if not self.enabled:
+            return
+        buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+        histograms = self._shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 2)
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def collector(self, name, kind, fn):
+        """Register fn() as the value of a gauge or counter kept elsewhere."""
+        self._collectors[name] = (kind, fn)
+
+    def snapshot(self):
+        """Return ({(name, labels): value}, {(name, labels): histogram})."""
+        counters = {}
+        histograms = {}
+        with self._lock:
+            self._retire_finished()
+            shards = [shard for _, shard in self._shards] + [self._retired]
+            for shard in shards:
+                # Copied first, the owning thread keeps writing
+                for key, value in list(shard.counters.items()):
+                    counters[key] = counters.get(key, 0) + value
+                for key, histogram in list(shard.histograms.items()):
+                    _add_histogram(histograms, key, list(histogram))
+        for name, (kind, fn) in self._collectors.items():
+            counters[(name, "")] = fn()
+        return counters, histograms
+
+    def render(self):
+        """Return every metric in Prometheus text format."""
+        counters, histograms = self.snapshot()
+        kinds = {name: kind for name, (kind, _) in self._collectors.items()}
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kinds.get(name, 'counter')}")
+                typed.add(name)
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+            prefix = f"{labels}," if labels else ""
+            count = 0
+            for bound, bucket in zip(buckets + ("+Inf",), histogram):
+                count += bucket
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {histogram[-1]}")
+            lines.append(f"{name}_count{suffix} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=METRICS_PORT, host=METRICS_HOST):
+        """Serve /metrics over HTTP from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes would flood the console
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print(f"[TELTCSERVER] Metrics on http://{host}:{port}/metrics")
+
+
+def _add_histogram(histograms, key, histogram):
+    total = histograms.get(key)
+    if total is None:
+        histograms[key] = histogram
+    else:
+        for i, value in enumerate(histogram):
+            total[i] += value
+
+
+def _merge(shard, counters, histograms):
+    for key, value in counters.items():
+        shard.counters[key] = shard.counters.get(key, 0) + value
+    for key, histogram in histograms.items():
+        _add_histogram(shard.histograms, key, list(histogram))
+
+
+def histogram_mean(histogram):
+    """Average of the values recorded in a histogram."""
+    count = sum(histogram[:-1])
+    return histogram[-1] / count if count else 0.0
+
+
+metrics = Metrics()
@@ -0,0 +1,115 @@
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Key derivation used for new hashes: "scrypt" or "pbkdf2"
+PASSWORD_HASH = os.getenv("PASSWORD_HASH", "scrypt").lower()
+SCRYPT_N = int(os.getenv("SCRYPT_N", "16384"))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+PBKDF2_ITERATIONS = int(os.getenv("PBKDF2_ITERATIONS", "200000"))
+
+# Hashing runs on a small pool so a login storm can't starve chat delivery
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "32"))  # Jobs queued or running
+HASH_PER_IP = int(os.getenv("HASH_PER_IP", "2"))  # Jobs per client IP at once
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * n * r * p
+    )
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+
+def hash_password(password):
+    """Hash a password with a random salt using the configured KDF."""
+    salt = os.urandom(16)
+    if PASSWORD_HASH == "pbkdf2":
+        digest = _pbkdf2(password, salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def is_legacy_hash(stored):
+    """Unsalted SHA-256 hex digest from older versions."""
+    return len(stored) == 64 and "$" not in stored
+
+
+def is_hashed(stored):
+    """False for plain text passwords left in hand-edited user files."""
+    return is_legacy_hash(stored) or stored.startswith(("scrypt$", "pbkdf2_sha256$"))
+
+
+def verify_password(password, stored):
+    """Check a password against any supported stored hash."""
+    if is_legacy_hash(stored):
+        digest = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(digest, stored)
+
+    scheme, *params = stored.split("$")
+    if scheme == "scrypt":
+        n, r, p, salt, expected = params
+        digest = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    elif scheme == "pbkdf2_sha256":
+        iterations, salt, expected = params
+        digest = _pbkdf2(password, bytes.fromhex(salt), int(iterations))
+    else:
+        return False
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def needs_rehash(stored):
+    """True if a hash is weaker than the current settings."""
+    if PASSWORD_HASH == "pbkdf2":
+        return not stored.startswith(f"pbkdf2_sha256${PBKDF2_ITERATIONS}$")
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+class HashPool:
+    """Bounded worker pool for password hashing.
+
+    Jobs beyond the queue limit, or beyond the per-IP limit, are refused
+    rather than queued, so hashing cost stays predictable under load.
+    """
+
+    def __init__(
+        self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT, per_ip=HASH_PER_IP
+    ):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="hash")
+        self.queue_limit = queue_limit
+        self.per_ip = per_ip
+        self.in_flight = 0
+        self.per_ip_in_flight = {}  # {ip: jobs}
+        self.lock = threading.Lock()
+
+    def submit(self, ip, job):
+        """Run job() on the pool.
+
+        Returns a Future, or None if the job was refused.
+        """
+        with self.lock:
+            if (
+                self.in_flight >= self.queue_limit
+                or self.per_ip_in_flight.get(ip, 0) >= self.per_ip
+            ):
+                return None
+            self.in_flight += 1
+            self.per_ip_in_flight[ip] = self.per_ip_in_flight.get(ip, 0) + 1
+        future = self.executor.submit(job)
+        future.add_done_callback(lambda _: self._release(ip))
+        return future
+
+    def _release(self, ip):
+        with self.lock:
+            self.in_flight -= 1
+            if self.per_ip_in_flight[ip] <= 1:
+                del self.per_ip_in_flight[ip]
+            else:
+                self.per_ip_in_flight[ip] -= 1
@@ -1,256 +1,564 @@
-from typing import Tuple
+import time
+from libs.charset import CHARSETS, get_charset
+from libs.admission import REJECTIONS
+from libs.bans import parse_duration, parse_network
+from libs.metrics import histogram_mean, metrics
+from libs.room_manager import HISTORY_REPLAY
+from libs.trie import PrefixTrie
+from libs.wrap import MIN_WIDTH
+
+# Actions a command can ask of the connection handler
+REPLY = "reply"  # Send payload to the client
+QUIT = "quit"  # Say goodbye and disconnect the client
+BROADCAST = "broadcast"  # Announce text to everyone
+KICK = "kick"  # Disconnect target, other clients' Sessions, then reply
+BAN = "ban"  # As KICK, telling them they were banned
+
+# Commands listed by /help, for guests, logged in users and admins
+GUEST_COMMANDS = {
+    "help": "Show this help message",
+    "login": "Login with username and password",
+    "whoami": "Show current username",
+    "register": "Register new user",
+    "charset": "Set terminal charset",
+    "width": "Set terminal width",
+    "quit": "Disconnect from server",
+}
+AUTH_COMMANDS = {
+    "broadcast": "Broadcast a message to all users",
+    "users": "List online users",
+    "join": "Join a chat room",
+    "rooms": "List available rooms",
+    "history": "Show recent messages in room",
+    "msg": "Send a private message",
+}
+# Commands whose first argument may be abbreviated; the others act on
+# accounts that may be offline, so they take exact names
+ABBREVIATED_ARGUMENTS = {"join", "kick", "charset"}
+ADMIN_COMMANDS = {
+    "op": "Give admin privileges to user",
+    "deop": "Remove admin privileges from user",
+    "kick": "Disconnect a user from the server",
+    "ban": "Ban a user or IP range, optionally for a time",
+    "unban": "Lift a ban",
+    "bans": "List bans",
+    "createroom": "Create a new chat room",
+    "banner": "Reload the banner files",
+    "stats": "Show server statistics",
+}
+
+
+class CommandResult:
+    """The outcome of a command.
+
+    text is the reply (or the broadcast message); payload() frames,
+    wraps and encodes it for a client, once per charset and width.
+    """
+
+    __slots__ = ("action", "text", "target", "payloads")
+
+    def __init__(self, action=REPLY, text="", target=None):
+        self.action = action
+        self.text = text
+        self.target = target
+        self.payloads = {}  # {(Charset, width): bytes}
+
+    def payload(self, session):
+        """Return the reply as sent to a session."""
+        key = (session.charset, session.wrap_width)
+        data = self.payloads.get(key)
+        if data is None:
+            data = self.payloads[key] = session.encode(f"\r\n{self.text}\r\n")
+        return data
+
+
+NO_REPLY = CommandResult()
 
 
 class CommandProcessor:
-    def __init__(self, user_manager, room_manager):
+    def __init__(self, user_manager, room_manager, banner_cache=None, messenger=None):
         self.user_manager = user_manager
         self.room_manager = room_manager
+        self.banner_cache = banner_cache
+        self.messenger = messenger
         self.commands = {
             "help": self.cmd_help,
             "login": self.cmd_login,
             "register": self.cmd_register,
+            "charset": self.cmd_charset,
+            "width": self.cmd_width,
             "whoami": self.cmd_whoami,
             "users": self.cmd_users,
             "op": self.cmd_op,
             "deop": self.cmd_deop,
             "kick": self.cmd_kick,
             "ban": self.cmd_ban,
+            "unban": self.cmd_unban,
+            "bans": self.cmd_bans,
             "broadcast": self.cmd_broadcast,
             "passwd": self.cmd_passwd,
             "join": self.cmd_join,
             "rooms": self.cmd_rooms,
+            "history": self.cmd_history,
+            "msg": self.cmd_msg,
             "createroom": self.cmd_createroom,
+            "banner": self.cmd_banner,
+            "stats": self.cmd_stats,
             "quit": self.cmd_quit,
         }
-
-    def process_command(self, message: str, addr: Tuple) -> str:
-        """Process a command and return the response."""
+        self.labels = {cmd: f'command="{cmd}"' for cmd in self.commands}
+        # Commands, and the names their first argument may abbreviate
+        self.command_names = PrefixTrie(self.commands)
+        self.argument_names = {
+            "join": room_manager.room_names,
+            "kick": user_manager.online_names,
+            "msg": user_manager.online_names,
+            "charset": PrefixTrie(CHARSETS),
+        }
+        # Replies that only change with the role or the room list, reused
+        self.help_replies = {}  # {(authenticated, admin, width): CommandResult}
+        self.room_replies = {}  # {(current room, width): CommandResult}
+        self.rooms_version = None  # room_manager.version room_replies is for
+        # Set by the async server: defer(fn, *args) runs fn on the event loop,
+        # resume(session) processes input held back while the session was busy
+        self.defer = None
+        self.resume = None
+
+    def process_command(self, message: str, session) -> CommandResult:
+        """Process a command and return its result."""
         parts = message.strip().split()
         if not parts:
-            return ""
+            return NO_REPLY
 
         cmd = parts[0].lower()
         args = parts[1:]
 
-        if cmd in self.commands:
-            return self.commands[cmd](args, addr)
-        return f"Unknown command: {cmd}. Type 'help' for available commands."
-
-    def cmd_help(self, args, addr):
+        handler = self.commands.get(cmd)
+        if handler is None:
+            # Accept any unambiguous abbreviation
+            full = self.command_names.resolve(cmd)
+            if full is None:
+                metrics.inc("tcserver_commands_total", labels='command="unknown"')
+                _, matches = self.command_names.complete(cmd)
+                if matches:
+                    return CommandResult(
+                        text=f"Ambiguous command: {cmd} ({', '.join(matches)})"
+                    )
+                return CommandResult(
+                    text=f"Unknown command: {cmd}. Type 'help' for available commands."
+                )
+            cmd, handler = full, self.commands[full]
+        if cmd in ABBREVIATED_ARGUMENTS and args:
+            names = self.argument_names[cmd]
+            args[0] = names.resolve(args[0]) or args[0]
+        started = time.perf_counter()
+        result = handler(args, session)
+        labels = self.labels[cmd]
+        metrics.inc("tcserver_commands_total", labels=labels)
+        metrics.observe(
+            "tcserver_command_seconds", time.perf_counter() - started, labels
+        )
+        # Most commands just reply with a string
+        if isinstance(result, CommandResult):
+            return result
+        return CommandResult(text=result) if result else NO_REPLY
+
+    def complete(self, line, session):
+        """Complete the last word of a line being typed, for TAB.
+
+        Completes command names, then the rooms or online users a command
+        takes; in chat, the last word completes to an online username.
+        Returns (extension, matches) as PrefixTrie.complete does, with a
+        space after a word completed in full.
+        """
+        words = line.split(" ")
+        names, prefix = self.user_manager.online_names, words[-1]
+        if line.startswith("/"):
+            cmd = words[0][1:].lower()
+            if len(words) == 1:
+                names, prefix = self.command_names, cmd
+            else:
+                names = self.argument_names.get(self.command_names.resolve(cmd) or cmd)
+                if names is None or len(words) > 2:
+                    return "", []
+        elif not prefix:
+            return "", []
+        extension, matches = names.complete(prefix)
+        if len(matches) == 1:
+            extension += " "
+        return extension, matches
+
+    def cmd_help(self, args, session):
         """Show available commands based on user's role."""
-        is_admin = self.user_manager.is_admin(addr)
-        is_authenticated = not self.user_manager.get_username(addr).startswith("guest_")
-
-        # Commands for all users (including guests)
-        guest_commands = {
-            "help": "Show this help message",
-            "login": "Login with username and password",
-            "whoami": "Show current username",
-            "register": "Register new user",
-            "quit": "Disconnect from server",
-        }
-
-        # Commands for authenticated users
-        auth_commands = {
-            "broadcast": "Broadcast a message to all users",
-            "users": "List online users",
-            "join": "Join a chat room",
-            "rooms": "List available rooms",
-        }
-
-        # Admin commands
-        admin_commands = {
-            "op": "Give admin privileges to user",
-            "deop": "Remove admin privileges from user",
-            "kick": "Disconnect a user from the server",
-            "ban": "Ban a username from the server",
-            "createroom": "Create a new chat room",
-        }
-
-        # Build help message
-        help_msg = [
-            "+-------------COMMANDS-------------+",
-            "#  Basic Commands:                #",
-        ]
-
-        # Add guest commands
-        for cmd, desc in guest_commands.items():
-            help_msg.append(f"# /{cmd:<10} - {desc:<15} #")
-
-        # Add authenticated user commands
+        key = (
+            not session.username.startswith("guest_"),
+            self.user_manager.is_admin(session),
+            session.wrap_width,
+        )
+        result = self.help_replies.get(key)
+        if result is None:
+            result = self.help_replies[key] = CommandResult(text=self._help(*key))
+        return result
+
+    def _help(self, is_authenticated, is_admin, width):
+        sections = [("Basic Commands", GUEST_COMMANDS)]
         if is_authenticated:
-            help_msg.append("#                                #")
-            help_msg.append("#  User Commands:                #")
-            for cmd, desc in auth_commands.items():
-                help_msg.append(f"# /{cmd:<10} - {desc:<15} #")
-
-        # Add admin commands
+            sections.append(("User Commands", AUTH_COMMANDS))
         if is_admin:
-            help_msg.append("#                                #")
-            help_msg.append("#  Admin Commands:               #")
-            for cmd, desc in admin_commands.items():
-                help_msg.append(f"# /{cmd:<10} - {desc:<15} #")
-
-        help_msg.append("+--------------------------------+")
+            sections.append(("Admin Commands", ADMIN_COMMANDS))
+
+        inner = max(
+            len(f"/{cmd:<10} - {desc}")
+            for _, commands in sections
+            for cmd, desc in commands.items()
+        )
+        if width and inner + 4 > width:
+            # Too narrow for the table: a plain list, wrapped like any text
+            help_msg = []
+            for title, commands in sections:
+                help_msg.append(f"{title}:")
+                help_msg.extend(f"/{cmd} - {desc}" for cmd, desc in commands.items())
+            return "\n".join(help_msg)
+
+        help_msg = ["+" + "COMMANDS".center(inner + 2, "-") + "+"]
+        for title, commands in sections:
+            if len(help_msg) > 1:
+                help_msg.append(f"# {'':<{inner}} #")
+            help_msg.append(f"# {title + ':':<{inner}} #")
+            for cmd, desc in commands.items():
+                help_msg.append(f"# {f'/{cmd:<10} - {desc}':<{inner}} #")
+        help_msg.append("+" + "-" * (inner + 2) + "+")
         return "\n".join(help_msg)
 
-    def cmd_login(self, args, addr):
+    def _offload(self, session, job, on_done):
+        """Run a password hashing job off the connection handler.
+
+        on_done(result) turns the job's result into the reply. In threaded
+        mode the client's own thread waits for it; when `defer` is set (async
+        mode) the session is marked busy, its further input is held back,
+        and the reply is sent from the event loop once the job finishes.
+        """
+        future = self.user_manager.hash_pool.submit(session.addr[0], job)
+        if future is None:
+            return "Server busy, please try again in a moment"
+
+        def reply_for(future):
+            # A failed job (e.g. a storage error) still gets the client a reply
+            try:
+                return on_done(future.result())
+            except Exception as error:
+                print(f"[TELTCSERVER] Job for {session.addr} failed: {error!r}")
+                return "Server error, please try again in a moment"
+
+        if self.defer is None:
+            return reply_for(future)
+
+        def finish(future):
+            session.busy = False
+            reply = reply_for(future)
+            if reply and session.conn:
+                session.conn.sendall(session.encode(f"\r\n{reply}\r\n"))
+            self.resume(session)
+
+        session.busy = True
+        future.add_done_callback(lambda future: self.defer(finish, future))
+        return ""
+
+    def cmd_login(self, args, session):
         """Handle login command."""
         if len(args) != 2:
             return "Usage: login <username> <password>"
 
         username, password = args
-        if self.user_manager.authenticate(username, password):
-            self.user_manager.register_session(addr, username)
-            self.user_manager.message_timestamps[addr] = []  # Reset rate limit
-            return f"Successfully logged in as {username}"
-        return "Invalid username or password"
 
-    def cmd_register(self, args, addr):
+        def logged_in(ok):
+            if not ok:
+                return "Invalid username or password"
+            if self.user_manager.is_banned(username):
+                return "This account is banned"
+            if not self.user_manager.login(session, username):
+                return None  # Disconnected while the password was checked
+            session.buckets.clear()  # Reset rate limit
+            reply = f"Successfully logged in as {username}"
+            if self.messenger:
+                mail = self.messenger.take_mail(username)
+                if mail:
+                    reply += f"\nYou have {len(mail)} new message(s):\n"
+                    reply += "\n".join(mail)
+            return reply
+
+        return self._offload(
+            session,
+            lambda: self.user_manager.authenticate(username, password),
+            logged_in,
+        )
+
+    def cmd_register(self, args, session):
         """Handle register command."""
         if len(args) != 2:
             return "Usage: register <username> <password>"
 
         username, password = args
-        if self.user_manager.add_user(username, password):
-            return f"User {username} registered successfully"
-        return "Username already exists"
+        if self.user_manager.get_user(username):
+            return "Username already exists"
+        if self.user_manager.is_banned(username):
+            return "This username is banned"
 
-    def cmd_whoami(self, args, addr):
+        def registered(ok):
+            if ok:
+                return f"User {username} registered successfully"
+            return "Username already exists"
+
+        return self._offload(
+            session, lambda: self.user_manager.add_user(username, password), registered
+        )
+
+    def cmd_whoami(self, args, session):
         """Show current username."""
-        username = self.user_manager.get_username(addr)
+        username = session.username
         return f"You are: {username}"
 
-    def cmd_users(self, args, addr):
+    def cmd_charset(self, args, session):
+        """Show or change the character set of the client's terminal."""
+        available = ", ".join(CHARSETS)
+        if not args:
+            return f"Charset: {session.charset.name} (available: {available})"
+        if len(args) != 1:
+            return "Usage: charset [name]"
+        charset = get_charset(args[0])
+        if charset is None:
+            return f"Unknown charset: {args[0]} (available: {available})"
+        session.set_charset(charset)
+        return f"Charset set to {charset.name}"
+
+    def cmd_width(self, args, session):
+        """Show or set the width text is wrapped at for the client."""
+        if not args:
+            width = session.wrap_width
+            if not width:
+                return "Wrapping is off"
+            if session.columns is not None:
+                source = "set with /width"
+            elif session.telnet.width:
+                source = "from the terminal"
+            else:
+                source = "default"
+            return f"Wrapping at {width} columns ({source})"
+        if len(args) != 1:
+            return "Usage: width [columns|auto|off]"
+        arg = args[0].lower()
+        if arg == "auto":
+            session.columns = None
+        elif arg == "off":
+            session.columns = 0
+        elif arg.isdigit() and int(arg) >= MIN_WIDTH:
+            session.columns = int(arg)
+        else:
+            return f"Width must be at least {MIN_WIDTH}, 'auto' or 'off'"
+        return self.cmd_width([], session)
+
+    def cmd_users(self, args, session):
         """List online users."""
         # Check if user is authenticated (not a guest)
-        username = self.user_manager.get_username(addr)
+        username = session.username
         if username.startswith("guest_"):
             return "You must be logged in to list users"
 
-        users = [
-            f"{addr}: {user}"
-            for addr, user in self.user_manager.active_sessions.items()
-        ]
-        return "Online users:\n" + "\n".join(users)
+        return "Online users:\n" + self.user_manager.online_listing()
 
-    def cmd_op(self, args, addr):
+    def cmd_op(self, args, session):
         """Make a user admin."""
-        if not self.user_manager.is_admin(addr):
+        if not self.user_manager.is_admin(session):
             return "You don't have permission to use this command"
         if len(args) != 1:
             return "Usage: op <username>"
         username = args[0]
-        if username in self.user_manager.users:
-            self.user_manager.users[username]["role"] = "admin"
-            self.user_manager._save_users()
+        if self.user_manager.set_role(username, "admin"):
             return f"User {username} is now an admin"
         return "User not found"
 
-    def cmd_deop(self, args, addr):
+    def cmd_deop(self, args, session):
         """Remove admin status from user."""
-        if not self.user_manager.is_admin(addr):
+        if not self.user_manager.is_admin(session):
             return "You don't have permission to use this command"
         if len(args) != 1:
             return "Usage: deop <username>"
         username = args[0]
-        if username in self.user_manager.users:
-            self.user_manager.users[username]["role"] = "user"
-            self.user_manager._save_users()
+        if self.user_manager.set_role(username, "user"):
             return f"User {username} is no longer an admin"
         return "User not found"
 
-    def cmd_kick(self, args, addr):
+    def cmd_kick(self, args, session):
         """Kick a user from the server."""
-        if not self.user_manager.is_admin(addr):
+        if not self.user_manager.is_admin(session):
             return "You don't have permission to use this command"
         if len(args) != 1:
             return "Usage: kick <username>"
         username = args[0]
 
         # Check if target is admin
-        for client_addr, client_name in self.user_manager.active_sessions.items():
-            if client_name == username:
-                if (
-                    username in self.user_manager.users
-                    and self.user_manager.users[username]["role"] == "admin"
-                ):
-                    return "Cannot kick an admin"
-                return f"@KICK@{client_addr}"
+        for client in self.user_manager.find_sessions(username):
+            if self.user_manager.is_admin(client):
+                return "Cannot kick an admin"
+            return CommandResult(KICK, target=(client,))
+        if self.user_manager.is_online_elsewhere(username):
+            if self.user_manager.role_of(username) == "admin":
+                return "Cannot kick an admin"
+            self.user_manager.publish("kick", username)
+            return f"User {username} has been kicked"
         return "User not found or not online"
 
-    def cmd_ban(self, args, addr):
-        """Ban a username."""
-        if not self.user_manager.is_admin(addr):
+    def cmd_ban(self, args, session):
+        """Ban a username or an IP address or range, and disconnect it."""
+        if not self.user_manager.is_admin(session):
+            return "You don't have permission to use this command"
+        if len(args) not in (1, 2):
+            return "Usage: ban <username|ip[/bits]> [duration, e.g. 30m, 12h, 7d]"
+        expires = until = None
+        if len(args) == 2:
+            seconds = parse_duration(args[1])
+            if seconds is None:
+                return "Duration must look like 90s, 30m, 12h or 7d"
+            expires = time.time() + seconds
+            until = time.strftime("%Y-%m-%d %H:%M", time.localtime(expires))
+        network = parse_network(args[0])
+        if network is not None:
+            kind, target = "ip", str(network)
+            sessions = self.user_manager.sessions_in_network(network)
+        else:
+            kind = "user"
+            target = username = args[0]
+            if self.user_manager.role_of(username) == "admin":
+                return "Cannot ban an admin"
+            sessions = list(self.user_manager.find_sessions(username))
+        self.user_manager.ban(kind, target, expires)
+        reply = f"{'Network' if kind == 'ip' else 'User'} {target} has been banned"
+        if until:
+            reply += f" until {until}"
+        sessions = tuple(s for s in sessions if s is not session)
+        return CommandResult(BAN, reply, sessions)
+
+    def cmd_unban(self, args, session):
+        """Lift a ban on a username or an IP address or range."""
+        if not self.user_manager.is_admin(session):
             return "You don't have permission to use this command"
         if len(args) != 1:
-            return "Usage: ban <username>"
-        username = args[0]
-        if (
-            username in self.user_manager.users
-            and self.user_manager.users[username]["role"] == "admin"
-        ):
-            return "Cannot ban an admin"
-        self.user_manager.ban_user(username)
-        return f"User {username} has been banned"
-
-    def cmd_broadcast(self, args, addr):
+            return "Usage: unban <username|ip[/bits]>"
+        network = parse_network(args[0])
+        kind = "user" if network is None else "ip"
+        if not self.user_manager.unban(kind, args[0]):
+            return f"{args[0]} is not banned"
+        return f"{args[0]} is no longer banned"
+
+    def cmd_bans(self, args, session):
+        """List the bans in force."""
+        if not self.user_manager.is_admin(session):
+            return "You don't have permission to use this command"
+        lines = []
+        for kind, target, expires in self.user_manager.bans.entries():
+            if expires is None:
+                until = "permanent"
+            else:
+                until = time.strftime("until %Y-%m-%d %H:%M", time.localtime(expires))
+            lines.append(f"{kind:<4} {target} ({until})")
+        return "\n".join(lines) if lines else "No bans"
+
+    def cmd_broadcast(self, args, session):
         """Broadcast a message to all users."""
         if not args:
             return "Usage: broadcast <message>"
 
         # Check if user is admin
-        if not self.user_manager.is_admin(addr):
+        if not self.user_manager.is_admin(session):
             return "You must be an admin to broadcast messages"
 
-        if self.user_manager.is_rate_limited(addr):
+        if self.user_manager.is_rate_limited(session, "broadcast"):
             return "Rate limit exceeded. Please wait a moment."
 
-        return f"@BROADCAST@{' '.join(args)}"
+        return CommandResult(BROADCAST, " ".join(args))
 
-    def cmd_passwd(self, args, addr):
+    def cmd_passwd(self, args, session):
         """Change password for current user."""
         if len(args) != 2:
             return "Usage: passwd <old_password> <new_password>"
 
         old_password, new_password = args
-        username = self.user_manager.get_username(addr)
+        username = session.username
 
         if username.startswith("guest_"):
             return "You must be logged in to change password"
 
-        if not self.user_manager.authenticate(username, old_password):
-            return "Current password is incorrect"
+        def change():
+            if not self.user_manager.authenticate(username, old_password):
+                return "Current password is incorrect"
+            if self.user_manager.change_password(username, new_password):
+                return "Password changed successfully"
+            return "Failed to change password"
 
-        if self.user_manager.change_password(username, new_password):
-            return "Password changed successfully"
-        return "Failed to change password"
+        return self._offload(session, change, lambda reply: reply)
 
-    def cmd_join(self, args, addr):
+    def cmd_join(self, args, session):
         """Join a chat room."""
         if len(args) != 1:
             return "Usage: join <room>"
 
         room_name = args[0]
-        if self.room_manager.join_room(addr, room_name):
+        if self.room_manager.join_room(session, room_name):
             return f"Joined room: {room_name}"
         return "Room not found"
 
-    def cmd_rooms(self, args, addr):
+    def cmd_msg(self, args, session):
+        """Send a private message to a user."""
+        if len(args) < 2:
+            return "Usage: msg <username> <message>"
+        if session.username.startswith("guest_"):
+            return "You must be logged in to send messages"
+        if self.messenger is None:
+            return "Private messages are not enabled"
+        return self.messenger.send(session.username, args[0], " ".join(args[1:]))
+
+    def cmd_rooms(self, args, session):
         """List available rooms."""
+        if self.rooms_version != self.room_manager.version:
+            self.room_replies = {}
+            self.rooms_version = self.room_manager.version
+        key = (self.room_manager.get_user_room(session), session.wrap_width)
+        result = self.room_replies.get(key)
+        if result is None:
+            result = self.room_replies[key] = CommandResult(text=self._rooms(*key))
+        return result
+
+    def _rooms(self, current_room, width):
         rooms = self.room_manager.list_rooms()
-        current_room = self.room_manager.get_user_room(addr)
-
-        room_list = ["+--------AVAILABLE ROOMS--------+"]
+        border = min(width, 31) if width else 31
+        name_width = 15 if border > 24 else 10
+        room_list = ["+" + "AVAILABLE ROOMS".center(border - 2, "-") + "+"]
         for name, desc in rooms.items():
             current = " (current)" if name == current_room else ""
-            room_list.append(f"# {name:<15} - {desc[:20]}{current}")
-        room_list.append("+-----------------------------+")
+            # Descriptions get whatever room is left on the line
+            room = width - name_width - 5 - len(current) if width else 20
+            room_list.append(f"# {name:<{name_width}} - {desc[:max(room, 0)]}{current}")
+        room_list.append("+" + "-" * (border - 2) + "+")
         return "\n".join(room_list)
 
-    def cmd_createroom(self, args, addr):
+    def cmd_history(self, args, session):
+        """Show the last messages of the current room."""
+        if len(args) > 1 or (args and not args[0].isdigit()):
+            return "Usage: history [count]"
+
+        count = int(args[0]) if args else HISTORY_REPLAY
+        room_name = self.room_manager.get_user_room(session)
+        history = self.room_manager.history(room_name, count)
+        if not history:
+            return "No recent messages in this room"
+        if not session.conn:
+            return history.strip()
+        session.conn.sendall(session.encode(history))
+        return ""
+
+    def cmd_createroom(self, args, session):
         """Create a new room (admin only)."""
-        if not self.user_manager.is_admin(addr):
+        if not self.user_manager.is_admin(session):
             return "You don't have permission to create rooms"
 
         if len(args) < 1:
@@ -263,6 +571,71 @@ class CommandProcessor:
             return f"Room {name} created successfully"
         return "Room already exists"
 
-    def cmd_quit(self, args, addr):
+    def cmd_banner(self, args, session):
+        """Reload the banner files (admin only)."""
+        if not self.user_manager.is_admin(session):
+            return "You don't have permission to reload the banner"
+        if self.banner_cache is None:
+            return "Banner cache is not enabled"
+        self.banner_cache.reload()
+        return f"Reloaded banners: {', '.join(sorted(self.banner_cache.variants))}"
+
+    def cmd_stats(self, args, session):
+        """Show server statistics (admin only)."""
+        if not self.user_manager.is_admin(session):
+            return "You don't have permission to use this command"
+        if not metrics.enabled:
+            return "Metrics are disabled"
+
+        counters, histograms = metrics.snapshot()
+
+        def count(name, labels=""):
+            return counters.get((name, labels), 0)
+
+        def mean_ms(name, labels=""):
+            histogram = histograms.get((name, labels))
+            return histogram_mean(histogram) * 1000 if histogram else 0.0
+
+        uptime = int(time.time() - metrics.started)
+        recipients = histograms.get(("tcserver_broadcast_recipients", ""))
+        auth_ok, auth_failed = 'result="ok"', 'result="failed"'
+        commands = sorted(
+            (
+                (value, labels.split('"')[1])
+                for (name, labels), value in counters.items()
+                if name == "tcserver_commands_total"
+            ),
+            reverse=True,
+        )
+        refused = []
+        for reason in REJECTIONS:
+            label = f'reason="{reason}"'
+            refused.append(
+                f"{reason} {count('tcserver_connections_rejected_total', label)}"
+            )
+        lines = [
+            f"Uptime: {uptime // 3600}h {uptime % 3600 // 60:02d}m",
+            f"Clients: {count('tcserver_connections_active')} online, "
+            f"{count('tcserver_connections_total')} total",
+            f"Lines: {count('tcserver_lines_total')}, "
+            f"avg {mean_ms('tcserver_line_seconds'):.2f} ms",
+            f"Broadcasts: {count('tcserver_broadcasts_total')}, "
+            f"avg {histogram_mean(recipients) if recipients else 0:.1f} recipients",
+            f"Broadcast time: avg {mean_ms('tcserver_broadcast_seconds'):.2f} ms, "
+            f"{count('tcserver_broadcast_failures_total')} failed",
+            f"Logins: {count('tcserver_auth_total', auth_ok)} ok, "
+            f"{count('tcserver_auth_total', auth_failed)} failed, "
+            f"avg {mean_ms('tcserver_auth_seconds'):.0f} ms",
+            f"Queued frames: {count('tcserver_queue_depth')}, "
+            f"max {count('tcserver_queue_depth_max')} per client",
+            f"Queue drops: {count('tcserver_queue_dropped_total')}, "
+            f"disconnects: {count('tcserver_queue_disconnects_total')}",
+            "Refused connections: " + ", ".join(refused),
+            "Top commands: "
+            + ", ".join(f"{name} {value}" for value, name in commands[:5]),
+        ]
+        return "\n".join(lines)
+
+    def cmd_quit(self, args, session):
         """Disconnect from the server."""
-        return "@QUIT@"
+        return CommandResult(QUIT)
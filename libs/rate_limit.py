@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+
+def parse_rate(spec):
+    """Parse a "count/seconds" rate spec into (rate per second, burst)."""
+    count, _, seconds = spec.partition("/")
+    count = float(count)
+    return count / float(seconds or 1), count
+
+
+# Limits as "count/seconds", e.g. "2/1" allows bursts of 2 refilled at 2 per second
+RATE_LIMITS = {
+    "chat": parse_rate(os.getenv("RATE_LIMIT_CHAT", "2/1")),
+    "command": parse_rate(os.getenv("RATE_LIMIT_COMMAND", "5/1")),
+    "broadcast": parse_rate(os.getenv("RATE_LIMIT_BROADCAST", "1/10")),
+}
+# Shared by every guest connection from one IP address, before login
+IP_RATE_LIMIT = parse_rate(os.getenv("RATE_LIMIT_IP", "10/1"))
+# How often idle per-IP buckets are evicted, in seconds
+RATE_LIMIT_EVICT_INTERVAL = float(os.getenv("RATE_LIMIT_EVICT_INTERVAL", "60"))
+
+
+class TokenBucket:
+    """Token bucket refilled lazily on each check."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def consume(self, now):
+        """Take a token if one is available."""
+        # now may predate a bucket created after it was read
+        elapsed = max(0.0, now - self.stamp)
+        tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = max(self.stamp, now)
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+    def is_idle(self, now):
+        """True once the bucket has refilled completely."""
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Per-session limits for chat, commands and broadcasts, plus per-IP
+    limits for guests that have not logged in yet."""
+
+    def __init__(self, limits=RATE_LIMITS, ip_limit=IP_RATE_LIMIT):
+        self.limits = limits
+        self.ip_limit = ip_limit
+        self.ip_buckets = {}  # {ip: TokenBucket}
+        self.lock = threading.Lock()
+
+    def allow(self, session, kind):
+        """Check and consume one action of the given kind for a session."""
+        now = time.monotonic()
+        if session.role == "guest":
+            with self.lock:
+                bucket = self.ip_buckets.get(session.addr[0])
+                if bucket is None:
+                    bucket = self.ip_buckets[session.addr[0]] = TokenBucket(
+                        *self.ip_limit
+                    )
+                if not bucket.consume(now):
+                    return False
+        bucket = session.buckets.get(kind)
+        if bucket is None:
+            bucket = session.buckets[kind] = TokenBucket(*self.limits[kind])
+        return bucket.consume(now)
+
+    def evict_idle(self):
+        """Drop per-IP buckets that have refilled, they hold no state."""
+        now = time.monotonic()
+        with self.lock:
+            for ip in [ip for ip, b in self.ip_buckets.items() if b.is_idle(now)]:
+                del self.ip_buckets[ip]
+
+    def start_eviction(self, interval=RATE_LIMIT_EVICT_INTERVAL):
+        """Evict idle per-IP buckets from a background timer thread."""
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
@@ -1,86 +1,197 @@
-from pathlib import Path
-import json
+import os
+import threading
+from collections import OrderedDict, deque
+from libs.storage import open_storage
+from libs.trie import PrefixTrie
+
+# Recent messages kept per room, capped by count and by encoded size
+HISTORY_LINES = int(os.getenv("HISTORY_LINES", "50"))
+HISTORY_ROOM_BYTES = int(os.getenv("HISTORY_ROOM_BYTES", "16384"))
+# Cap over all rooms; the history of the least recently active rooms goes first
+HISTORY_TOTAL_BYTES = int(os.getenv("HISTORY_TOTAL_BYTES", "4194304"))
+# Messages replayed to a client joining a room
+HISTORY_REPLAY = int(os.getenv("HISTORY_REPLAY", "10"))
 
 
 class Room:
     def __init__(self, name, description=""):
         self.name = name
         self.description = description
-        self.users = set()  # Set of addr tuples
+        self.users = set()  # Set of Sessions
+        self.history = deque()  # Encoded message frames, oldest first
+        self.history_bytes = 0
 
-    def add_user(self, addr):
-        self.users.add(addr)
+    def add_user(self, session):
+        self.users.add(session)
 
-    def remove_user(self, addr):
-        self.users.discard(addr)
+    def remove_user(self, session):
+        self.users.discard(session)
 
 
 class RoomManager:
-    def __init__(self):
+    def __init__(
+        self,
+        storage=None,
+        history_lines=HISTORY_LINES,
+        history_room_bytes=HISTORY_ROOM_BYTES,
+        history_total_bytes=HISTORY_TOTAL_BYTES,
+    ):
         self.rooms = {}  # {name: Room}
-        self.user_rooms = {}  # {addr: room_name}
-        self.rooms_file = Path("data/rooms.json")
+        self.version = 0  # Bumped whenever a room is added
+        self.room_names = PrefixTrie()
+        self.history_lines = history_lines
+        self.history_room_bytes = history_room_bytes
+        self.history_total_bytes = history_total_bytes
+        self.history_bytes = 0  # Over all rooms
+        self.active_rooms = OrderedDict()  # Rooms with history, coldest first
+        self.history_lock = threading.Lock()
+        # Set when running as one of several workers:
+        # publish(kind, *args) tells the other workers about a change
+        self.publish = None
+        self.storage = storage or open_storage()
         self._load_rooms()
 
     def _load_rooms(self):
-        if self.rooms_file.exists():
-            with open(self.rooms_file) as f:
-                rooms_data = json.load(f)
-                for name, data in rooms_data.items():
-                    self.rooms[name] = Room(name, data.get("description", ""))
+        rooms_data = self.storage.load_rooms()
+        if rooms_data:
+            for name, data in rooms_data.items():
+                self.rooms[name] = Room(name, data.get("description", ""))
+                self.room_names.add(name)
         else:
             # Create default lounge
-            self.rooms_file.parent.mkdir(exist_ok=True)
             self.rooms["lounge"] = Room("lounge", "The default chat room")
-            self._save_rooms()
-
-    def _save_rooms(self):
-        rooms_data = {
-            name: {"description": room.description} for name, room in self.rooms.items()
-        }
-        with open(self.rooms_file, "w") as f:
-            json.dump(rooms_data, f, indent=2)
+            self.room_names.add("lounge")
+            self._save_room("lounge")
+
+    def reload(self):
+        """Pick up rooms added or changed in storage by other processes."""
+        for name, data in self.storage.load_rooms().items():
+            room = self.rooms.get(name)
+            if room is None:
+                self.rooms[name] = Room(name, data.get("description", ""))
+                self.room_names.add(name)
+            elif room.description != data.get("description", ""):
+                room.description = data.get("description", "")
+            else:
+                continue
+            self.version += 1
+
+    def _save_room(self, name):
+        room = self.rooms[name]
+        self.storage.upsert_room(name, {"description": room.description})
+        if self.publish:
+            self.publish("room", room.name, room.description)
+
+    def add_remote_room(self, name, description):
+        """Add a room created by another worker or node."""
+        if name.lower() not in self.rooms:
+            self.rooms[name.lower()] = Room(name, description)
+            self.room_names.add(name.lower())
+            self.version += 1
+            self.storage.upsert_room(name.lower(), {"description": description})
 
     def create_room(self, name, description=""):
         if name.lower() in self.rooms:
             return False
         self.rooms[name.lower()] = Room(name, description)
-        self._save_rooms()
+        self.room_names.add(name.lower())
+        self.version += 1
+        self._save_room(name.lower())
         return True
 
-    def join_room(self, addr, room_name):
+    def join_room(self, session, room_name):
         """Join a chat room."""
         room_name = room_name.lower()
         if room_name not in self.rooms:
             return False
 
-        # Get old room for notification
-        old_room = None
-        if addr in self.user_rooms:
-            old_room_name = self.user_rooms[addr]
-            old_room = self.rooms[old_room_name]
-
         # Remove from current room
-        self.leave_current_room(addr)
+        self.leave_current_room(session)
 
         # Add to new room
-        self.rooms[room_name].add_user(addr)
-        self.user_rooms[addr] = room_name
+        self.rooms[room_name].add_user(session)
+        session.room = room_name
 
+        # Catch up on the conversation in one write
+        replay = self.history(room_name, HISTORY_REPLAY)
+        if replay and session.conn:
+            session.conn.sendall(session.encode(replay))
         return True
 
-    def leave_current_room(self, addr):
-        if addr in self.user_rooms:
-            current_room = self.rooms[self.user_rooms[addr]]
-            current_room.remove_user(addr)
-            del self.user_rooms[addr]
+    def leave_current_room(self, session):
+        if session.room is not None:
+            self.rooms[session.room].remove_user(session)
+            session.room = None
 
     def get_room_users(self, room_name):
         room = self.rooms.get(room_name.lower())
         return room.users if room else set()
 
-    def get_user_room(self, addr):
-        return self.user_rooms.get(addr, "lounge")
+    def get_user_room(self, session):
+        return session.room or "lounge"
 
     def list_rooms(self):
         return {name: room.description for name, room in self.rooms.items()}
+
+    def record(self, room, frame):
+        """Add a UTF-8 encoded message frame to a room's history."""
+        if self.history_lines <= 0:
+            return
+        with self.history_lock:
+            room.history.append(frame)
+            room.history_bytes += len(frame)
+            self.history_bytes += len(frame)
+            while room.history and (
+                len(room.history) > self.history_lines
+                or room.history_bytes > self.history_room_bytes
+            ):
+                self._drop_oldest(room)
+            self.active_rooms[room] = None
+            self.active_rooms.move_to_end(room)
+
+            # Over the global cap: forget the rooms that went quiet longest
+            while self.history_bytes > self.history_total_bytes:
+                cold = next(iter(self.active_rooms))
+                if cold is room:
+                    self._drop_oldest(room)
+                    continue
+                del self.active_rooms[cold]
+                self.history_bytes -= cold.history_bytes
+                cold.history.clear()
+                cold.history_bytes = 0
+            if not room.history:
+                del self.active_rooms[room]
+
+    def _drop_oldest(self, room):
+        frame = room.history.popleft()
+        room.history_bytes -= len(frame)
+        self.history_bytes -= len(frame)
+
+    def history(self, room_name, count):
+        """Return the last count messages of a room as a single text."""
+        room = self.rooms.get(room_name.lower())
+        if room is None or count <= 0:
+            return ""
+        with self.history_lock:
+            frames = list(room.history)[-count:]
+        if not frames:
+            return ""
+        header = f"\r\n--- Last {len(frames)} messages in {room.name} ---\r\n"
+        return header + b"".join(frames).decode("utf-8")
+
+    def export_history(self):
+        """Return every room's history as {name: [message]}, oldest first."""
+        with self.history_lock:
+            return {
+                name: [frame.decode("utf-8") for frame in room.history]
+                for name, room in self.rooms.items()
+                if room.history
+            }
+
+    def restore_history(self, history):
+        """Record the messages returned by export_history()."""
+        for name, messages in history.items():
+            room = self.rooms.get(name)
+            if room is not None:
+                for message in messages:
+                    self.record(room, message.encode("utf-8"))
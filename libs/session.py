@@ -0,0 +1,103 @@
+import time
+from collections import deque
+
+from libs.charset import default_charset, get_charset
+from libs.line_buffer import LineBuffer
+from libs.telnet import TelnetParser
+from libs.wrap import DEFAULT_WIDTH, width_bucket, wrap
+
+
+class Session:
+    """Everything the server knows about one connected client.
+
+    A single Session object is shared by the connection handler, the
+    user and room managers and the command processor, so per-client
+    state lives in exactly one place.
+    """
+
+    __slots__ = (
+        "conn",  # SocketConnection/StreamConnection, None for the console
+        "addr",  # (host, port) of the client
+        "username",
+        "role",  # "guest", "user" or "admin"
+        "room",  # Name of the current room, None until joined
+        "buckets",  # {kind: TokenBucket} rate limits, created on first use
+        "telnet",  # TelnetParser for the input stream
+        "charset",  # Charset the client's terminal uses
+        "decode",  # Decodes the client's input chunk by chunk, see Charset
+        "columns",  # Width set with /width, 0 for none; None follows NAWS
+        "line_buffer",  # LineBuffer with the line being typed
+        "pending_lines",  # Complete lines waiting to be processed
+        "busy",  # True while a command runs in the background (e.g. /login)
+        "last_active",  # time.monotonic() of the last input
+        "idle_warned",  # True once told about the idle timeout
+    )
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.username = None
+        self.role = "guest"
+        self.room = None
+        self.buckets = {}
+        self.telnet = TelnetParser()
+        self.set_charset(default_charset)
+        self.columns = None
+        self.line_buffer = LineBuffer()
+        self.pending_lines = deque()
+        self.busy = False
+        self.last_active = time.monotonic()
+        self.idle_warned = False
+
+    def export(self):
+        """Return the state a new server process needs to carry on with
+        this client, as JSON-friendly values."""
+        return {
+            "addr": list(self.addr),
+            "username": self.username,
+            "room": self.room,
+            "telnet": self.telnet.export(),
+            "charset": self.charset.name,
+            "columns": self.columns,
+            "line": self.line_buffer.line,
+            "pending_lines": list(self.pending_lines),
+            "idle": time.monotonic() - self.last_active,
+            "idle_warned": self.idle_warned,
+        }
+
+    @classmethod
+    def restore(cls, conn, state):
+        """Rebuild a session from export(); username and room are left for
+        the user and room managers to set."""
+        session = cls(conn, tuple(state["addr"]))
+        session.telnet.restore(state["telnet"])
+        session.set_charset(get_charset(state["charset"]) or default_charset)
+        session.columns = state["columns"]
+        session.line_buffer.line = state["line"]
+        session.pending_lines.extend(state["pending_lines"])
+        session.idle_warned = state["idle_warned"]
+        return session
+
+    def set_charset(self, charset):
+        """Switch the character set used for this client's input and output."""
+        self.charset = charset
+        self.decode = charset.decoder()
+
+    @property
+    def wrap_width(self):
+        """Width text sent to this client is wrapped at, 0 for none."""
+        columns = self.columns
+        if columns is None:
+            columns = self.telnet.width or DEFAULT_WIDTH
+        return width_bucket(columns)
+
+    def encode(self, text):
+        """Wrap and encode text for this client."""
+        return self.charset.encode(wrap(text, self.wrap_width))
+
+    def constant(self, text):
+        """encode() for messages that never change, cached."""
+        return self.charset.constant(text, self.wrap_width)
+
+    def __repr__(self):
+        return f"<Session {self.username} {self.addr}>"
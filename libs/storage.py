@@ -0,0 +1,268 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+# "sqlite" (default) or "json" for the legacy flat files
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+DATA_DIR = Path(os.getenv("DATA_DIR", "data"))
+
+
+class JSONStorage:
+    """Users and rooms kept in the original users.json/rooms.json files,
+    offline messages in mail.json and bans in bans.json.
+
+    Every change rewrites the whole file, but through a temporary file
+    and an atomic rename, so a crash never leaves a half-written file.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.users_file = Path(data_dir) / "users.json"
+        self.rooms_file = Path(data_dir) / "rooms.json"
+        self.mail_file = Path(data_dir) / "mail.json"
+        self.bans_file = Path(data_dir) / "bans.json"
+        self.users_file.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.users = self._read(self.users_file)
+        self.rooms = self._read(self.rooms_file)
+        self.mail = self._read(self.mail_file)  # {recipient: [message]}
+        self.bans = self._read(self.bans_file)  # {kind: {target: expires}}
+
+    def reload(self):
+        """Read the files again, after they were changed by another process."""
+        with self.lock:
+            self.users = self._read(self.users_file)
+            self.rooms = self._read(self.rooms_file)
+            self.mail = self._read(self.mail_file)
+            self.bans = self._read(self.bans_file)
+
+    def _read(self, path):
+        if not path.exists():
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _write(self, path, data):
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load_users(self):
+        return dict(self.users)
+
+    def get_user(self, username):
+        user = self.users.get(username)
+        return dict(user) if user else None
+
+    def upsert_user(self, username, record):
+        with self.lock:
+            self.users[username] = dict(record)
+            self._write(self.users_file, self.users)
+
+    def load_rooms(self):
+        return dict(self.rooms)
+
+    def upsert_room(self, name, record):
+        with self.lock:
+            self.rooms[name] = dict(record)
+            self._write(self.rooms_file, self.rooms)
+
+    def add_mail(self, recipient, message, limit):
+        """Queue a message; False if the recipient already has limit."""
+        with self.lock:
+            mailbox = self.mail.setdefault(recipient, [])
+            if len(mailbox) >= limit:
+                return False
+            mailbox.append(dict(message))
+            self._write(self.mail_file, self.mail)
+            return True
+
+    def take_mail(self, recipient):
+        """Remove and return a recipient's queued messages, oldest first."""
+        with self.lock:
+            mailbox = self.mail.pop(recipient, [])
+            if mailbox:
+                self._write(self.mail_file, self.mail)
+            return mailbox
+
+    def load_bans(self):
+        return [
+            (kind, target, expires)
+            for kind, targets in self.bans.items()
+            for target, expires in targets.items()
+        ]
+
+    def upsert_ban(self, kind, target, expires):
+        with self.lock:
+            self.bans.setdefault(kind, {})[target] = expires
+            self._write(self.bans_file, self.bans)
+
+    def delete_ban(self, kind, target):
+        with self.lock:
+            if self.bans.get(kind, {}).pop(target, False) is not False:
+                self._write(self.bans_file, self.bans)
+
+
+class SQLiteStorage:
+    """Users, rooms, offline messages and bans in a SQLite database in
+    WAL mode.
+
+    Each change is a single-row upsert in its own transaction, so writes
+    stay cheap no matter how many users exist, and a crash mid-write
+    leaves the database intact.
+    """
+
+    def __init__(self, path=DATA_DIR / "tcserver.db"):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " username TEXT PRIMARY KEY, password TEXT NOT NULL, role TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS rooms ("
+                " name TEXT PRIMARY KEY, description TEXT NOT NULL DEFAULT '')"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS mail ("
+                " id INTEGER PRIMARY KEY, recipient TEXT NOT NULL,"
+                " sender TEXT NOT NULL, text TEXT NOT NULL, sent REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS mail_recipient ON mail (recipient)"
+            )
+            # expires is a time.time() value, NULL for a permanent ban
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS bans ("
+                " kind TEXT NOT NULL, target TEXT NOT NULL, expires REAL,"
+                " PRIMARY KEY (kind, target))"
+            )
+
+    def reload(self):
+        """Nothing to do, every query reads the database."""
+
+    def is_empty(self):
+        with self.lock:
+            return not (
+                self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone()
+                or self.db.execute("SELECT 1 FROM rooms LIMIT 1").fetchone()
+            )
+
+    def load_users(self):
+        with self.lock:
+            rows = self.db.execute("SELECT username, password, role FROM users")
+            return {name: {"password": pw, "role": role} for name, pw, role in rows}
+
+    def get_user(self, username):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT password, role FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        return {"password": row[0], "role": row[1]} if row else None
+
+    def upsert_user(self, username, record):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO users (username, password, role) VALUES (?, ?, ?)"
+                " ON CONFLICT(username) DO UPDATE SET"
+                " password = excluded.password, role = excluded.role",
+                (username, record["password"], record["role"]),
+            )
+
+    def load_rooms(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name, description FROM rooms")
+            return {name: {"description": desc} for name, desc in rows}
+
+    def upsert_room(self, name, record):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO rooms (name, description) VALUES (?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET description = excluded.description",
+                (name, record.get("description", "")),
+            )
+
+    def add_mail(self, recipient, message, limit):
+        """Queue a message; False if the recipient already has limit."""
+        with self.lock, self.db:
+            (queued,) = self.db.execute(
+                "SELECT COUNT(*) FROM mail WHERE recipient = ?", (recipient,)
+            ).fetchone()
+            if queued >= limit:
+                return False
+            self.db.execute(
+                "INSERT INTO mail (recipient, sender, text, sent) VALUES (?, ?, ?, ?)",
+                (recipient, message["sender"], message["text"], message["sent"]),
+            )
+            return True
+
+    def take_mail(self, recipient):
+        """Remove and return a recipient's queued messages, oldest first."""
+        with self.lock, self.db:
+            rows = self.db.execute(
+                "SELECT sender, text, sent FROM mail WHERE recipient = ? ORDER BY id",
+                (recipient,),
+            ).fetchall()
+            if rows:
+                self.db.execute("DELETE FROM mail WHERE recipient = ?", (recipient,))
+        return [{"sender": s, "text": text, "sent": sent} for s, text, sent in rows]
+
+    def load_bans(self):
+        with self.lock:
+            return self.db.execute("SELECT kind, target, expires FROM bans").fetchall()
+
+    def upsert_ban(self, kind, target, expires):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO bans (kind, target, expires) VALUES (?, ?, ?)"
+                " ON CONFLICT(kind, target) DO UPDATE SET expires = excluded.expires",
+                (kind, target, expires),
+            )
+
+    def delete_ban(self, kind, target):
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM bans WHERE kind = ? AND target = ?", (kind, target)
+            )
+
+    def import_json(self, data_dir=DATA_DIR):
+        """Copy users and rooms from the legacy JSON files in one transaction."""
+        legacy = JSONStorage(data_dir)
+        users, rooms = legacy.load_users(), legacy.load_rooms()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO users (username, password, role) VALUES (?, ?, ?)",
+                [(name, u["password"], u["role"]) for name, u in users.items()],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO rooms (name, description) VALUES (?, ?)",
+                [(name, r.get("description", "")) for name, r in rooms.items()],
+            )
+        return len(users), len(rooms)
+
+
+def open_storage(backend=STORAGE_BACKEND, data_dir=DATA_DIR):
+    """Open the configured storage backend.
+
+    A new SQLite database is seeded from the JSON files on first start.
+    """
+    if backend == "json":
+        return JSONStorage(data_dir)
+    if backend != "sqlite":
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+    storage = SQLiteStorage(Path(data_dir) / "tcserver.db")
+    if storage.is_empty():
+        users, rooms = storage.import_json(data_dir)
+        if users or rooms:
+            print(f"[STORAGE] Imported {users} users and {rooms} rooms from JSON")
+    return storage
@@ -0,0 +1,232 @@
+import os
+
+# Negotiate options with the client on connect (disable for raw TCP terminals)
+TELNET_NEGOTIATION = os.getenv("TELNET_NEGOTIATION", "1") == "1"
+# Seconds to wait for the client's answers before sending the banner
+NEGOTIATION_TIMEOUT = float(os.getenv("NEGOTIATION_TIMEOUT", "0.5"))
+
+# Telnet commands (RFC 854)
+SE = 240
+NOP = 241
+EC = 247
+AYT = 246
+SB = 250
+WILL = 251
+WONT = 252
+DO = 253
+DONT = 254
+IAC = 255
+
+# Telnet options
+ECHO = 1  # RFC 857
+SGA = 3  # Suppress go-ahead, RFC 858
+NAWS = 31  # Window size, RFC 1073
+LINEMODE = 34  # RFC 1184
+
+# LINEMODE suboption MODE and its flags
+LM_MODE = 1
+LM_MODE_EDIT = 1
+
+# Options the server performs itself, and options it asks the client for
+LOCAL_OPTIONS = (ECHO, SGA)
+REMOTE_OPTIONS = (NAWS, LINEMODE)
+
+# Parser states
+_DATA, _IAC, _OPTION, _SB, _SB_IAC = range(5)
+
+
+def command(verb, option):
+    return bytes((IAC, verb, option))
+
+
+def subnegotiation(option, payload):
+    payload = bytes(payload).replace(b"\xff", b"\xff\xff")
+    return bytes((IAC, SB, option)) + payload + bytes((IAC, SE))
+
+
+class TelnetParser:
+    """Incremental telnet protocol parser and option negotiator.
+
+    feed() strips IAC sequences from the byte stream and returns the plain
+    data. Any negotiation replies are collected in `replies` and must be
+    sent back to the client by the caller.
+    """
+
+    def __init__(self):
+        self.state = _DATA
+        self.verb = None
+        self.sb_option = None
+        self.sb_data = bytearray()
+        # Options we perform, and options the client performs
+        self.local = dict.fromkeys(LOCAL_OPTIONS, False)
+        self.remote = dict.fromkeys(REMOTE_OPTIONS, False)
+        self.pending = set()  # (verb, option) requests awaiting an answer
+        self.echo_refused = False
+        self.replies = bytearray()
+        self.width = None
+        self.height = None
+
+    def initial_negotiation(self):
+        """Return the option requests to send when a client connects."""
+        if not TELNET_NEGOTIATION:
+            return b""
+        requests = [(WILL, ECHO), (WILL, SGA), (DO, NAWS), (DO, LINEMODE)]
+        self.pending.update(requests)
+        return b"".join(command(verb, option) for verb, option in requests)
+
+    @property
+    def linemode(self):
+        """True once the client edits lines locally and sends them whole."""
+        return self.remote[LINEMODE]
+
+    @property
+    def awaiting_window_size(self):
+        """True until the client reported its size or refused NAWS."""
+        if (DO, NAWS) in self.pending:
+            return True
+        return self.remote[NAWS] and self.width is None
+
+    @property
+    def server_echo(self):
+        """Whether the server should echo typed characters back."""
+        return not (self.linemode or self.echo_refused)
+
+    def export(self):
+        """Return the negotiated state, for a new server process taking
+        the connection over."""
+        return {
+            "local": [option for option, on in self.local.items() if on],
+            "remote": [option for option, on in self.remote.items() if on],
+            "pending": sorted(self.pending),
+            "echo_refused": self.echo_refused,
+            "size": [self.width, self.height],
+        }
+
+    def restore(self, state):
+        """Continue from the state returned by export()."""
+        for option in state["local"]:
+            self.local[option] = True
+        for option in state["remote"]:
+            self.remote[option] = True
+        self.pending = {tuple(request) for request in state["pending"]}
+        self.echo_refused = state["echo_refused"]
+        self.width, self.height = state["size"]
+
+    def take_replies(self):
+        """Return and clear the negotiation bytes waiting to be sent."""
+        replies = bytes(self.replies)
+        self.replies.clear()
+        return replies
+
+    def feed(self, data):
+        """Parse a received chunk and return the data bytes it carries."""
+        if self.state == _DATA and IAC not in data:
+            return data  # Fast path: no telnet commands in this chunk
+
+        view = memoryview(data)
+        out = bytearray()
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if self.state == _DATA:
+                iac = data.find(IAC, pos)
+                if iac < 0:
+                    out += view[pos:]
+                    break
+                out += view[pos:iac]
+                self.state = _IAC
+                pos = iac + 1
+                continue
+
+            byte = data[pos]
+            pos += 1
+            if self.state == _IAC:
+                self.state = _DATA
+                if byte == IAC:
+                    out.append(IAC)  # Escaped 0xFF data byte
+                elif byte in (WILL, WONT, DO, DONT):
+                    self.verb = byte
+                    self.state = _OPTION
+                elif byte == SB:
+                    self.sb_option = None
+                    self.sb_data.clear()
+                    self.state = _SB
+                elif byte == EC:
+                    out.append(8)  # Erase character becomes a backspace
+                elif byte == AYT:
+                    self.replies += b"\r\n[Yes]\r\n"
+            elif self.state == _OPTION:
+                self.state = _DATA
+                self._negotiate(self.verb, byte)
+            elif self.state == _SB:
+                if byte == IAC:
+                    self.state = _SB_IAC
+                elif self.sb_option is None:
+                    self.sb_option = byte
+                else:
+                    self.sb_data.append(byte)
+            elif self.state == _SB_IAC:
+                if byte == SE:
+                    self.state = _DATA
+                    self._subnegotiation(self.sb_option, self.sb_data)
+                else:
+                    self.sb_data.append(byte)  # IAC IAC inside a suboption
+                    self.state = _SB
+        return bytes(out)
+
+    def _negotiate(self, verb, option):
+        if verb in (DO, DONT):
+            self._negotiate_local(verb == DO, option)
+        else:
+            self._negotiate_remote(verb == WILL, option)
+
+    def _negotiate_local(self, enable, option):
+        """Handle DO/DONT for an option the server would perform."""
+        answer = WILL if enable else WONT
+        if option == ECHO and enable and self.linemode:
+            # Line mode clients echo themselves; keep the server's echo off
+            if (WONT, ECHO) not in self.pending:
+                self.replies += command(WONT, ECHO)
+            return
+        requested = (WILL, option) in self.pending or (WONT, option) in self.pending
+        self.pending.discard((WILL, option))
+        self.pending.discard((WONT, option))
+        if option == ECHO and not enable and not self.linemode:
+            self.echo_refused = True  # The client echoes locally instead
+        if option not in self.local:
+            if enable:
+                self.replies += command(WONT, option)
+            return
+        if self.local[option] != enable:
+            self.local[option] = enable
+            if not requested:
+                self.replies += command(answer, option)
+
+    def _negotiate_remote(self, enable, option):
+        """Handle WILL/WONT for an option the client would perform."""
+        answer = DO if enable else DONT
+        requested = (DO, option) in self.pending or (DONT, option) in self.pending
+        self.pending.discard((DO, option))
+        self.pending.discard((DONT, option))
+        if option not in self.remote:
+            if enable:
+                self.replies += command(DONT, option)
+            return
+        if self.remote[option] == enable:
+            return
+        self.remote[option] = enable
+        if not requested:
+            self.replies += command(answer, option)
+        if option == LINEMODE and enable:
+            # Let the client edit and echo lines itself
+            self.replies += subnegotiation(LINEMODE, (LM_MODE, LM_MODE_EDIT))
+            if self.local[ECHO] or (WILL, ECHO) in self.pending:
+                self.local[ECHO] = False
+                self.pending.discard((WILL, ECHO))
+                self.pending.add((WONT, ECHO))
+                self.replies += command(WONT, ECHO)
+
+    def _subnegotiation(self, option, data):
+        if option == NAWS and len(data) >= 4:
+            self.width = (data[0] << 8) | data[1]
+            self.height = (data[2] << 8) | data[3]
@@ -0,0 +1,105 @@
+import threading
+
+
+class _Node:
+    __slots__ = ("children", "word", "count")
+
+    def __init__(self):
+        self.children = {}  # {char: _Node}
+        self.word = None  # The word ending here, in its original case
+        self.count = 0  # Words ending in this subtree
+
+
+class PrefixTrie:
+    """Words looked up by prefix, ignoring case.
+
+    Adding or removing a word touches only the nodes along its path, and
+    lookups walk only the typed prefix (plus the matches returned), so
+    they stay fast however many words are stored.
+    """
+
+    def __init__(self, words=()):
+        self.root = _Node()
+        self.lock = threading.Lock()
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        """Add a word; adding it again does nothing."""
+        with self.lock:
+            path = [self.root]
+            for char in word.lower():
+                path.append(path[-1].children.setdefault(char, _Node()))
+            if path[-1].word is not None:
+                return
+            path[-1].word = word
+            for node in path:
+                node.count += 1
+
+    def remove(self, word):
+        """Remove a word, if present."""
+        key = word.lower()
+        with self.lock:
+            path = [self.root]
+            for char in key:
+                node = path[-1].children.get(char)
+                if node is None:
+                    return
+                path.append(node)
+            if path[-1].word is None:
+                return
+            path[-1].word = None
+            for node in path:
+                node.count -= 1
+            # Prune the branch the word no longer needs
+            for depth in range(len(key), 0, -1):
+                if path[depth].count:
+                    break
+                del path[depth - 1].children[key[depth - 1]]
+
+    def _find(self, prefix):
+        node = self.root
+        for char in prefix.lower():
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def resolve(self, prefix):
+        """Return the word prefix stands for: an exact match, or the only
+        word starting with it. None if there is none or several."""
+        with self.lock:
+            node = self._find(prefix)
+            if node is None or (node.word is None and node.count != 1):
+                return None
+            while node.word is None:
+                node = next(iter(node.children.values()))
+            return node.word
+
+    def complete(self, prefix, limit=20):
+        """Return (extension, matches).
+
+        extension is what every word starting with prefix continues with
+        (the whole rest of the word if there is only one), matches up to
+        limit of those words in alphabetical order.
+        """
+        with self.lock:
+            node = self._find(prefix)
+            if node is None:
+                return "", []
+            extension = []
+            while node.word is None and len(node.children) == 1:
+                char, node = next(iter(node.children.items()))
+                extension.append(char)
+            matches = []
+            stack = [node]
+            while stack and len(matches) < limit:
+                node = stack.pop()
+                if node.word is not None:
+                    matches.append(node.word)
+                stack.extend(
+                    node.children[char] for char in sorted(node.children, reverse=True)
+                )
+        if len(matches) == 1:
+            return matches[0][len(prefix) :], matches
+        return "".join(extension), matches
@@ -1,54 +1,83 @@
-import json
-import os
 import random
 import string
-from pathlib import Path
+import threading
 import time
-import hashlib
+from libs.bans import BanList, in_network
+from libs.passwords import (
+    HashPool,
+    hash_password,
+    is_hashed,
+    needs_rehash,
+    verify_password,
+)
+from libs.metrics import metrics
+from libs.rate_limit import RateLimiter
+from libs.storage import open_storage
+from libs.trie import PrefixTrie
 
 
 class UserManager:
-    def __init__(self):
-        self.users = {}  # {username: {'password': hash, 'role': role}}
-        self.active_sessions = {}  # {addr: username}
-        self.users_file = Path("data/users.json")
-        self.message_timestamps = {}  # {addr: [timestamps]}
-        self.banned_users = set()  # Store banned usernames
-        self._load_users()
-
-    def _hash_password(self, password):
-        """Hash a password using SHA-256."""
-        return hashlib.sha256(password.encode()).hexdigest()
-
-    def _load_users(self):
-        """Load users from JSON file."""
-        if self.users_file.exists():
-            with open(self.users_file) as f:
-                self.users = json.load(f)
-                # Convert any plain text passwords to hashed
-                needs_update = False
-                for username, data in self.users.items():
-                    if len(data["password"]) != 64:  # Not a SHA-256 hash
-                        data["password"] = self._hash_password(data["password"])
-                        needs_update = True
-                if needs_update:
-                    self._save_users()
-        else:
-            # Create default admin user if no users exist
-            self.users_file.parent.mkdir(exist_ok=True)
-            default_password = self._hash_password("admin")  # Hash the default password
-            self.users = {
-                "admin": {
-                    "password": default_password,
-                    "role": "admin",
-                }
-            }
-            self._save_users()
-
-    def _save_users(self):
-        """Save users to JSON file."""
-        with open(self.users_file, "w") as f:
-            json.dump(self.users, f, indent=2)
+    def __init__(self, storage=None):
+        self.active_sessions = {}  # {addr: Session}
+        self.sessions_by_name = {}  # {username.lower(): {Session}}
+        self.sessions_by_role = {}  # {role: {Session}}, guests have role "guest"
+        self.online_names = PrefixTrie()  # Usernames in sessions_by_name
+        self.online_lines = {}  # {Session: line in the /users listing}
+        self._online_listing = None  # Cached join of online_lines
+        self.sessions_lock = threading.Lock()
+        self.storage = storage or open_storage()
+        self.bans = BanList(self.storage)
+        self.rate_limiter = RateLimiter()
+        self.hash_pool = HashPool()
+        self.users_lock = threading.Lock()  # Guards account creation
+        self.remote_users = {}  # {source: {username: room}} on other workers/nodes
+        self.remote_names = {}  # {username.lower(): {source}} of remote_users
+        # Set when running as one of several workers:
+        # publish(kind, *args) tells the other workers about a change
+        self.publish = None
+        self._prepare_accounts()
+
+    def _prepare_accounts(self):
+        """Hash plain text passwords left in hand-edited user files, and
+        create the default admin if there are no users.
+
+        Accounts are not kept in memory; they are looked up in storage
+        by username when needed.
+        """
+        users = self.storage.load_users()
+        for username, data in users.items():
+            if not is_hashed(data["password"]):
+                data["password"] = hash_password(data["password"])
+                self._save_user(username, data)
+        if not users:
+            default_password = hash_password("admin")  # Hash the default password
+            self._save_user("admin", {"password": default_password, "role": "admin"})
+
+    def reload(self):
+        """Pick up accounts and bans changed in storage by other processes."""
+        self._prepare_accounts()
+        with self.sessions_lock:
+            online = {session.username for session in self.active_sessions.values()}
+        for username in online:
+            user = self.get_user(username)
+            if user:
+                self._update_role(username, user["role"])
+        self.bans.reload()
+
+    def get_user(self, username):
+        """Return a user's account record, or None if there is none."""
+        return self.storage.get_user(username)
+
+    def _save_user(self, username, record):
+        """Write one user's record to storage."""
+        self.storage.upsert_user(username, record)
+        if self.publish:
+            self.publish("user", username, dict(record))
+
+    def update_user(self, username, record):
+        """Apply an account change made by another worker or node."""
+        self.storage.upsert_user(username, record)
+        self._update_role(username, record["role"])
 
     def generate_guest_name(self):
         """Generate a random guest username."""
@@ -56,79 +85,207 @@ class UserManager:
         return f"guest_{suffix}"
 
     def authenticate(self, username, password):
-        """Check if username and password match."""
-        if username in self.users:
-            hashed_password = self._hash_password(password)
-            return self.users[username]["password"] == hashed_password
-        return False
-
-    def register_session(self, addr, username=None):
-        """Register a new session for an address."""
+        """Check if username and password match.
+
+        Slow by design; call it from the hash pool. A hash made with older
+        settings is upgraded on successful login.
+        """
+        started = time.perf_counter()
+        user = self.get_user(username)
+        ok = bool(user) and verify_password(password, user["password"])
+        metrics.inc(
+            "tcserver_auth_total", labels=f'result="{"ok" if ok else "failed"}"'
+        )
+        metrics.observe("tcserver_auth_seconds", time.perf_counter() - started)
+        if not ok:
+            return False
+        if needs_rehash(user["password"]):
+            user["password"] = hash_password(password)
+            self._save_user(username, user)
+        return True
+
+    def register_session(self, session, username=None):
+        """Register a session, as a new guest or under a username."""
         if not username:
             username = self.generate_guest_name()
-        self.active_sessions[addr] = username
+        with self.sessions_lock:
+            self._unindex_session(session)
+            session.username = username
+            session.role = self.role_of(username)
+            self.active_sessions[session.addr] = session
+            self._index_session(session)
         return username
 
-    def get_username(self, addr):
-        """Get username for an address."""
-        return self.active_sessions.get(addr)
+    def login(self, session, username):
+        """Switch a session to a logged in user.
 
-    def remove_session(self, addr):
-        """Remove a session."""
-        if addr in self.active_sessions:
-            del self.active_sessions[addr]
+        Returns False if the client disconnected in the meantime.
+        """
+        with self.sessions_lock:
+            if session.conn and self.active_sessions.get(session.addr) is not session:
+                return False
+            self._unindex_session(session)
+            session.username = username
+            session.role = self.role_of(username)
+            self.active_sessions[session.addr] = session
+            self._index_session(session)
+        return True
 
-    def add_user(self, username, password, role="user"):
-        """Add a new user."""
-        if username not in self.users:
-            self.users[username] = {
-                "password": self._hash_password(password),
-                "role": role,
-            }
-            self._save_users()
+    def remove_session(self, session):
+        """Remove a session. Returns False if it was already removed."""
+        with self.sessions_lock:
+            if self.active_sessions.get(session.addr) is not session:
+                return False
+            self._unindex_session(session)
+            del self.active_sessions[session.addr]
             return True
-        return False
 
-    def is_admin(self, addr):
-        """Check if user is admin."""
-        username = self.get_username(addr)
-        return username in self.users and self.users[username]["role"] == "admin"
+    def role_of(self, username):
+        """Return the role of a username's account, or "guest" without one."""
+        user = self.get_user(username)
+        return user["role"] if user else "guest"
+
+    def _index_session(self, session):
+        sessions = self.sessions_by_name.get(session.username.lower())
+        if sessions is None:
+            sessions = self.sessions_by_name[session.username.lower()] = set()
+            self.online_names.add(session.username)
+        sessions.add(session)
+        self.sessions_by_role.setdefault(session.role, set()).add(session)
+        self.online_lines[session] = f"{session.addr}: {session.username}"
+        self._online_listing = None
+
+    def _unindex_session(self, session):
+        if session.username is None:
+            return
+        sessions = self.sessions_by_name.get(session.username.lower())
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self.sessions_by_name[session.username.lower()]
+                self.online_names.remove(session.username)
+        self.sessions_by_role.get(session.role, set()).discard(session)
+        self.online_lines.pop(session, None)
+        self._online_listing = None
+
+    def find_sessions(self, username):
+        """Return the sessions a username is logged in with."""
+        return self.sessions_by_name.get(username.lower(), set())
+
+    def is_online(self, username):
+        """Check if a username has at least one active session."""
+        return username.lower() in self.sessions_by_name
 
-    def is_rate_limited(self, addr):
-        """Check if user is rate limited (2 messages per second)."""
-        if self.is_admin(addr):
+    def sessions_with_role(self, role):
+        """Return the sessions with the given role."""
+        return self.sessions_by_role.get(role, set())
+
+    def is_online_elsewhere(self, username):
+        """Check if a username is online on another worker or node."""
+        return username.lower() in self.remote_names
+
+    def set_remote_users(self, source, users):
+        """Replace the users known to be online on another worker or node."""
+        with self.sessions_lock:
+            for name in self.remote_users.get(source, ()):
+                sources = self.remote_names.get(name.lower())
+                if sources is not None:
+                    sources.discard(source)
+                    if not sources:
+                        del self.remote_names[name.lower()]
+            if users:
+                self.remote_users[source] = users
+                for name in users:
+                    self.remote_names.setdefault(name.lower(), set()).add(source)
+            else:
+                self.remote_users.pop(source, None)
+            self._online_listing = None
+
+    def online_listing(self):
+        """Return the online users listing, rebuilt only after a change."""
+        listing = self._online_listing
+        if listing is None:
+            with self.sessions_lock:
+                lines = list(self.online_lines.values())
+                for source, users in sorted(self.remote_users.items()):
+                    lines.extend(f"{source}: {name}" for name in users)
+                listing = "\n".join(lines)
+                self._online_listing = listing
+        return listing
+
+    def set_role(self, username, role):
+        """Change a user's role and move their sessions in the role index."""
+        user = self.get_user(username)
+        if not user:
             return False
+        user["role"] = role
+        self._save_user(username, user)
+        self._update_role(username, role)
+        return True
 
-        now = time.time()
-        timestamps = self.message_timestamps.setdefault(addr, [])
+    def _update_role(self, username, role):
+        """Move a user's sessions in the role index."""
+        with self.sessions_lock:
+            for session in list(self.find_sessions(username)):
+                if session.username != username:
+                    continue
+                self.sessions_by_role.get(session.role, set()).discard(session)
+                self.sessions_by_role.setdefault(role, set()).add(session)
+                session.role = role
 
-        # Remove timestamps older than 1 second
-        timestamps = [t for t in timestamps if now - t < 1]
-        self.message_timestamps[addr] = timestamps
+    def add_user(self, username, password, role="user"):
+        """Add a new user."""
+        if self.get_user(username):
+            return False
+        password = hash_password(password)
+        with self.users_lock:
+            if self.get_user(username):
+                return False  # Registered while the password was hashing
+            self._save_user(username, {"password": password, "role": role})
+        return True
 
-        # Check if more than 2 messages in the last second
-        if len(timestamps) >= 2:
-            return True
+    def is_admin(self, session):
+        """Check if user is admin."""
+        return session.role == "admin"
+
+    def is_rate_limited(self, session, kind="chat"):
+        """Check if a chat message, command or broadcast is rate limited.
 
-        timestamps.append(now)
-        return False
+        Admins are only limited on broadcasts.
+        """
+        if session.role == "admin" and kind != "broadcast":
+            return False
+        return not self.rate_limiter.allow(session, kind)
 
-    def ban_user(self, username):
-        """Ban a username."""
-        self.banned_users.add(username.lower())
+    def ban(self, kind, target, expires=None):
+        """Ban a username ("user") or an IP network ("ip"), see BanList."""
+        self.bans.add(kind, target, expires)
+        if self.publish:
+            self.publish("ban", kind, target, expires)
 
-    def unban_user(self, username):
-        """Unban a username."""
-        self.banned_users.discard(username.lower())
+    def unban(self, kind, target):
+        """Lift a ban; returns False if there was none."""
+        if not self.bans.remove(kind, target):
+            return False
+        if self.publish:
+            self.publish("unban", kind, target)
+        return True
 
     def is_banned(self, username):
         """Check if username is banned."""
-        return username.lower() in self.banned_users
+        return self.bans.is_user_banned(username)
+
+    def sessions_in_network(self, network):
+        """Return the sessions connected from addresses in an IP network."""
+        with self.sessions_lock:
+            sessions = list(self.active_sessions.values())
+        return [s for s in sessions if in_network(s.addr[0], network)]
 
     def change_password(self, username, new_password):
         """Change a user's password."""
-        if username in self.users:
-            self.users[username]["password"] = self._hash_password(new_password)
-            self._save_users()
-            return True
-        return False
+        user = self.get_user(username)
+        if not user:
+            return False
+        user["password"] = hash_password(new_password)
+        self._save_user(username, user)
+        return True
@@ -0,0 +1,127 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import wait
+
+# Processes sharing the listening port; 1 runs everything in one process
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+# Seconds between updates of who is online on each worker
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "1.0"))
+
+
+class WorkerBus:
+    """A worker's link to the other workers, through the supervisor.
+
+    publish() sends an event to every other worker. Events from the other
+    workers are passed to handlers[kind](*args) from a background thread,
+    or through dispatch(handler, *args) when one is given.
+    """
+
+    def __init__(self, worker_id, pipe):
+        self.worker_id = worker_id
+        self.pipe = pipe
+        self.lock = threading.Lock()  # Pipes aren't safe for concurrent sends
+
+    def publish(self, kind, *args):
+        """Send an event to the other workers."""
+        with self.lock:
+            try:
+                self.pipe.send((kind, args))
+            except OSError:
+                pass  # Supervisor is gone, we are about to exit
+
+    def start(self, handlers, dispatch=None):
+        """Start delivering events to handlers.
+
+        handlers["exit"]() is called when the supervisor goes away.
+        """
+        thread = threading.Thread(target=self._receive_loop, args=(handlers, dispatch))
+        thread.daemon = True
+        thread.start()
+
+    def _receive_loop(self, handlers, dispatch):
+        while True:
+            try:
+                kind, args = self.pipe.recv()
+            except (EOFError, OSError):
+                handlers["exit"]()
+                return
+            handler = handlers.get(kind)
+            if handler is None:
+                continue
+            if dispatch:
+                dispatch(handler, *args)
+            else:
+                handler(*args)
+
+
+class Supervisor:
+    """Starts the worker processes and relays events between them.
+
+    Each worker runs target(worker_id, pipe, *args).
+    """
+
+    def __init__(self, count, target, *args):
+        # Spawned rather than forked: each worker opens its own storage
+        # connection and starts its own threads
+        context = multiprocessing.get_context("spawn")
+        self.processes = {}  # {worker_id: Process}
+        self.pipes = {}  # {worker_id: Connection}
+        self.locks = {}  # {worker_id: Lock}
+        for worker_id in range(count):
+            pipe, child_pipe = context.Pipe()
+            process = context.Process(
+                target=target,
+                args=(worker_id, child_pipe, *args),
+                name=f"worker-{worker_id}",
+            )
+            process.start()
+            child_pipe.close()
+            self.processes[worker_id] = process
+            self.pipes[worker_id] = pipe
+            self.locks[worker_id] = threading.Lock()
+
+    def send(self, worker_id, kind, *args):
+        """Send an event to one worker."""
+        pipe = self.pipes.get(worker_id)
+        if pipe is None:
+            return
+        with self.locks[worker_id]:
+            try:
+                pipe.send((kind, args))
+            except OSError:
+                pass  # Worker exited, relay() will notice
+
+    def send_signal(self, signum):
+        """Pass a signal on to every worker still running."""
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def relay(self):
+        """Forward every event to all other workers until none are left."""
+        while self.pipes:
+            worker_ids = {pipe: worker_id for worker_id, pipe in self.pipes.items()}
+            for pipe in wait(list(worker_ids)):
+                worker_id = worker_ids[pipe]
+                try:
+                    kind, args = pipe.recv()
+                except (EOFError, OSError):
+                    print(f"[TELTCSERVER] Worker {worker_id} exited")
+                    del self.pipes[worker_id]
+                    # Its clients are gone with it
+                    self._send_all(worker_id, "presence", f"worker {worker_id}", {})
+                    continue
+                self._send_all(worker_id, kind, *args)
+
+    def _send_all(self, sender_id, kind, *args):
+        for worker_id in list(self.pipes):
+            if worker_id != sender_id:
+                self.send(worker_id, kind, *args)
+
+    def terminate(self):
+        """Stop every worker, letting them flush their logs."""
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=5)
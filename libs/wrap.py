@@ -0,0 +1,37 @@
+import os
+import textwrap
+
+# Columns assumed until a client reports its window size; 0 disables wrapping
+DEFAULT_WIDTH = int(os.getenv("DEFAULT_WIDTH", "80"))
+# Terminal widths text is wrapped for, the widest that fits is used, so
+# clients with similar widths share one wrapped copy of each broadcast
+WIDTH_BUCKETS = (20, 22, 32, 40, 64, 80, 100, 132)
+# Narrowest width /width accepts
+MIN_WIDTH = WIDTH_BUCKETS[0]
+
+
+def width_bucket(columns):
+    """Return the width to wrap at for a terminal, 0 for no wrapping."""
+    if not columns:
+        return 0
+    bucket = columns
+    for width in WIDTH_BUCKETS:
+        if width > columns:
+            break
+        bucket = width
+    # Stay clear of the last column, terminals wrap on their own there
+    return max(bucket - 1, 1)
+
+
+def wrap(text, width):
+    """Word-wrap every line of text to width columns, keeping its line endings."""
+    if not width or len(text) <= width:
+        return text
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        end = "\r" if line.endswith("\r") else ""
+        body = line[: len(line) - len(end)]
+        if len(body) > width:
+            wrapped = textwrap.wrap(body, width, drop_whitespace=True)
+            lines[i] = f"{end}\n".join(wrapped) + end
+    return "\n".join(lines)
@@ -1,282 +1,903 @@
+import asyncio
+import selectors
 import socket
+import sys
 import threading
 import os
-from dotenv import load_dotenv
+import signal
+import time
+from dotenv import dotenv_values, load_dotenv
+
+# The environment as started, before .env is applied; a hot restart starts
+# the new process from it so that it reads .env afresh
+BASE_ENVIRON = dict(os.environ)
+# Load environment variables before the libs read their settings
+load_dotenv()
+
 from libs.broadcast import broadcast_message
+from libs.connection import (
+    SocketConnection,
+    StreamConnection,
+    enable_keepalive,
+    queue_stats,
+)
+from libs.session import Session
+from libs.telnet import NEGOTIATION_TIMEOUT
+from libs.storage import STORAGE_BACKEND, open_storage
+from libs.event_log import EventLog, LOG_CHAT
+from libs.handoff import HANDOFF_ENV, HANDOFF_FLUSH, Gate, Handoff, take_over
+from libs.idle import KEEPALIVE_INTERVAL, IdleReaper
+from libs.metrics import METRICS_PORT, metrics
 from libs.user_manager import UserManager
-from libs.process_message import CommandProcessor
-from libs.banner import load_banner
+from libs.process_message import BAN, BROADCAST, KICK, QUIT, CommandProcessor
+from libs.messages import Messenger
+from libs.charset import CHARSETS
+from libs.banner import BannerCache
 from libs.room_manager import RoomManager
-from datetime import datetime
-
-# Load environment variables
-load_dotenv()
+from libs.cluster import CLUSTER_NODE, CLUSTER_PORT, Cluster
+from libs.bans import parse_network
+from libs.admission import LISTEN_BACKLOG, REJECTIONS, Admission, refuse
+from libs.rate_limit import TokenBucket, parse_rate
+from libs.workers import PRESENCE_INTERVAL, SERVER_WORKERS, Supervisor, WorkerBus
 
 # Server configuration
 HOST = "0.0.0.0"  # Listen on all available network interfaces
-PORT = 2323  # Standard Telnet alternative port
+PORT = int(os.getenv("PORT", "2323"))  # Standard Telnet alternative port
 MAX_CONNECTIONS = int(
     os.getenv("MAX_CONNECTIONS", "5")
 )  # Default to 5 if not specified
+SERVER_MODE = os.getenv("SERVER_MODE", "threaded").lower()  # "threaded" or "async"
 
-# Dictionary to store active connections
-active_connections = {}
-connections_lock = threading.Lock()  # Thread-safe operations on active_connections
+RATE_LIMITED = "\r\nRate limit exceeded. Please wait a moment.\r\n"
+KICKED = "\r\nYou have been kicked.\r\n"
+BANNED = "\r\nYou have been banned from this server.\r\n"
 
 # Initialize user management
-user_manager = UserManager()
-room_manager = RoomManager()
-command_processor = CommandProcessor(user_manager, room_manager)
-
-
-def log_connection(addr, event_type, username=None):
+storage = open_storage()
+user_manager = UserManager(storage)
+room_manager = RoomManager(storage)
+banner_cache = BannerCache()
+messenger = Messenger(user_manager, storage)
+command_processor = CommandProcessor(
+    user_manager, room_manager, banner_cache, messenger
+)
+admission = Admission(MAX_CONNECTIONS, bans=user_manager.bans)
+# Closed while the clients are handed over to a new process (threaded mode)
+gate = Gate()
+
+# Sessions of connected clients, by address
+active_connections = user_manager.active_sessions
+
+event_log = EventLog()
+idle_reaper = IdleReaper(
+    lambda session: active_connections.get(session.addr) is session
+    and not session.conn.closing
+)
+
+
+def queue_depths():
+    """Return the frames queued for all clients, and the most for any one."""
+    depths = [s.conn.depth for s in list(active_connections.values()) if s.conn]
+    return sum(depths), max(depths, default=0)
+
+
+metrics.collector(
+    "tcserver_connections_active", "gauge", lambda: len(active_connections)
+)
+metrics.collector("tcserver_queue_depth", "gauge", lambda: queue_depths()[0])
+metrics.collector("tcserver_queue_depth_max", "gauge", lambda: queue_depths()[1])
+metrics.collector(
+    "tcserver_queue_dropped_total", "counter", lambda: queue_stats["dropped"]
+)
+metrics.collector(
+    "tcserver_queue_disconnects_total", "counter", lambda: queue_stats["disconnected"]
+)
+metrics.collector(
+    "tcserver_hash_jobs", "gauge", lambda: user_manager.hash_pool.in_flight
+)
+metrics.collector("tcserver_log_dropped_total", "counter", lambda: event_log.dropped)
+metrics.collector(
+    "tcserver_idle_disconnects_total", "counter", lambda: idle_reaper.reaped
+)
+# Commands whose arguments contain passwords
+SECRET_COMMANDS = ("login", "register", "passwd")
+
+# Link to the other workers, when running as one of SERVER_WORKERS processes
+bus = None
+# Links to the other nodes, when CLUSTER_PORT is set
+cluster = None
+# How the other workers or nodes label the users online here
+presence_source = None
+# asyncio Server accepting clients, in async mode
+async_server = None
+
+
+def log_connection(session, event_type):
     """Log connection events with timestamp."""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    addr = session.addr
     ip = addr[0] if addr[0] != "console" else "SERVER"
-    username = username or user_manager.get_username(addr)
+    event_log.log("connections", f"{ip} - {event_type} - {session.username}")
 
-    log_entry = f"[{timestamp}] {ip} - {event_type} - {username}\n"
 
-    # Ensure logs directory exists
-    os.makedirs("logs", exist_ok=True)
+def is_secret_command(message):
+    """Check if a command line may carry a password, abbreviated or not."""
+    words = message[1:].split()
+    if not words:
+        return False
+    name = command_processor.command_names.resolve(words[0])
+    if name is None:  # Unknown or ambiguous, keep it out of the log anyway
+        return any(secret.startswith(words[0].lower()) for secret in SECRET_COMMANDS)
+    return name in SECRET_COMMANDS
 
-    # Append to daily log file
-    date = datetime.now().strftime("%Y-%m-%d")
-    with open(f"logs/connections_{date}.log", "a") as f:
-        f.write(log_entry)
 
+def log_chat(session, message):
+    """Log a chat message or command, if chat logging is enabled."""
+    if not LOG_CHAT:
+        return
+    if message.startswith("/") and is_secret_command(message):
+        message = message.split()[0]  # Never log passwords
+    event_log.log(
+        "chat", f"{session.addr[0]} - {session.username}@{session.room} - {message}"
+    )
 
-def handle_backspace(display_buffer, conn):
-    """Handle backspace/delete character input."""
-    if display_buffer:
-        display_buffer = display_buffer[:-1]
-        # Send backspace, space, backspace to clear the character
-        conn.sendall(b"\x08 \x08")
-    return display_buffer
 
+def publish(kind, *args):
+    """Tell the other workers and cluster nodes about an event."""
+    if bus:
+        bus.publish(kind, *args)
+    if cluster:
+        cluster.publish(kind, *args)
 
-def process_input_byte(byte, display_buffer, conn):
-    """Process a single byte of input and handle display."""
-    if byte in (127, 8):  # Backspace/delete
-        return handle_backspace(display_buffer, conn)
 
-    # Only accept printable ASCII characters (32-126)
-    if 32 <= byte <= 126:
-        display_buffer += bytes([byte])
-        conn.sendall(bytes([byte]))
-    return display_buffer
+def announce(message, sender=None):
+    """Send a system message to every client, on all workers and nodes."""
+    broadcast_message(active_connections.values(), message, sender, system_msg=True)
+    publish("announce", message)
 
 
-def process_complete_line(line, addr, active_connections, conn):
+def process_complete_line(line, session):
     """Process a complete line of input and broadcast if valid."""
+    conn = session.conn
+    started = time.perf_counter()
+    metrics.inc("tcserver_lines_total")
     try:
-        message = line.decode("ascii").strip()
+        message = line.strip()
         if not message:
             return
+        log_chat(session, message)
 
         # Check if it's a command
         if message.startswith("/"):
-            response = command_processor.process_command(message[1:], addr)
-            if response.startswith("@QUIT@"):
+            if user_manager.is_rate_limited(session, "command"):
                 if conn:
-                    cleanup_client_connection(addr)  # Clean up first
-                    conn.sendall(b"\r\nGoodbye!\r\n")
-                    conn.close()
-                return
-            if response.startswith("@BROADCAST@"):
-                parts = response.split("@", 2)
-                broadcast_msg = parts[2] if len(parts) > 2 else ""
-                username = user_manager.get_username(addr)
-                broadcast_message(
-                    active_connections,
-                    f"[BROADCAST] {username}: {broadcast_msg}",
-                    system_msg=True,
-                )
-                return
-            if response.startswith("@KICK@"):
-                # Handle kick command
-                target_addr = eval(
-                    response.split("@")[2]
-                )  # Safe since we control the string
-                if target_addr in active_connections:
-                    active_connections[target_addr].sendall(
-                        b"\r\nYou have been kicked.\r\n"
-                    )
-                    active_connections[target_addr].close()
+                    conn.sendall(session.constant(RATE_LIMITED))
                 return
-            if response and conn:  # Only send response if there's a connection
-                conn.sendall(f"\r\n{response}\r\n".encode("ascii"))
+            result = command_processor.process_command(message[1:], session)
+            if result.action == QUIT:
+                if conn:
+                    cleanup_client_connection(session)  # Clean up first
+                    conn.sendall(session.constant("\r\nGoodbye!\r\n"))
+                    conn.close()
+            elif result.action == BROADCAST:
+                announce(f"[BROADCAST] {session.username}: {result.text}")
+            elif result.action in (KICK, BAN):
+                disconnect(result.target, BANNED if result.action == BAN else KICKED)
+                if result.text and conn:
+                    conn.sendall(result.payload(session))
+            elif result.text and conn:  # Only send if there's a connection
+                conn.sendall(result.payload(session))
         else:
             # Regular chat message
-            username = user_manager.get_username(addr)
+            username = session.username
 
             # Check if user is authenticated (not a guest)
             if username.startswith("guest_"):
                 if conn:  # Only send if there's a connection
                     conn.sendall(
-                        b"\r\nYou must be logged in to chat. Use /help for commands.\r\n"
+                        session.constant(
+                            "\r\nYou must be logged in to chat. Use /help for commands.\r\n"
+                        )
                     )
                 return
 
             # Check rate limit
-            if user_manager.is_rate_limited(addr):
+            if user_manager.is_rate_limited(session):
                 if conn:  # Only send if there's a connection
-                    conn.sendall(b"\r\nRate limit exceeded. Please wait a moment.\r\n")
+                    conn.sendall(session.constant(RATE_LIMITED))
                 return
 
             # Broadcast the message
-            current_room = room_manager.get_user_room(addr)
+            current_room = room_manager.get_user_room(session)
             room = room_manager.rooms[current_room]
             message_with_user = f"[{username}@{current_room}]: {message}"
 
-            # Send to room members
-            broadcast_message(
-                active_connections,
-                message_with_user,
-                addr,
-                room,
-            )
+            # Send to room members and the users mentioned
+            deliver_chat(room, message_with_user, session)
+            publish("chat", current_room, message_with_user)
 
             # Send back to sender (if not console)
             if conn:
-                conn.sendall(f"\r\n{message_with_user}\r\n".encode("ascii"))
+                conn.sendall(session.encode(f"\r\n{message_with_user}\r\n"))
             else:
                 print(f"\r\n{message_with_user}\r\n")
 
-    except UnicodeDecodeError:
-        print("UnicodeDecodeError: ", line)
+    finally:
+        metrics.observe("tcserver_line_seconds", time.perf_counter() - started)
 
 
-def handle_client(conn, addr):
-    """
-    Handles individual client connections.
+def deliver_chat(room, message, sender=None):
+    """Send a chat message to a room, highlighted for the users it mentions."""
+    mentioned = messenger.mentioned(message, sender)
+    broadcast_message(
+        active_connections.values(), message, sender, room, skip=mentioned
+    )
+    messenger.highlight(mentioned, message)
+    room_manager.record(room, f"{message}\r\n".encode("utf-8"))
 
-    Args:
-        conn (socket): Client socket connection
-        addr (tuple): Client address information
-    """
-    print(f"Connected by {addr}")
-    log_connection(addr, "CONNECT")
 
-    # Register as guest initially
-    username = user_manager.register_session(addr)
-    room_manager.join_room(addr, "lounge")  # Put user in default room
+def open_client_session(session):
+    """Register a new client and start telnet negotiation."""
+    conn = session.conn
+    print(f"Connected by {session.addr}")
 
-    # Check if username is banned
-    if user_manager.is_banned(username):
-        conn.sendall(b"You are banned from this server.\r\n")
-        conn.close()
-        return
+    metrics.inc("tcserver_connections_total")
+    # Register as guest initially; banned networks never get this far
+    user_manager.register_session(session)
+    log_connection(session, "CONNECT")
+    idle_reaper.watch(session)
+
+    negotiation = session.telnet.initial_negotiation()
+    if negotiation:
+        conn.sendall(negotiation)
 
-    with connections_lock:
-        active_connections[addr] = conn
+
+def send_welcome(session):
+    """Send the banner and welcome message, and announce the new client."""
+    username = session.username
 
     # Send banner and welcome message
-    banner = load_banner()
     welcome_msg = (
-        f"\r\n{banner}\r\n"
-        f"You are connected as: {username}\r\n"
+        f"\r\nYou are connected as: {username}\r\n"
         "Type '/help' for available commands.\r\n"
     )
-    conn.sendall(welcome_msg.encode("ascii"))
-    broadcast_message(
-        active_connections,
-        f"* New user connected from {addr[0]} as {username}",
-        addr,
-        system_msg=True,
+    charset = session.charset
+    banner = banner_cache.get(session.telnet.width, charset is CHARSETS["petscii"])
+    session.conn.sendall(
+        charset.constant("\r\n") + banner + session.encode(welcome_msg)
     )
+    room_manager.join_room(session, "lounge")  # Put user in default room
+    announce(f"* New user connected from {session.addr[0]} as {username}", session)
+
+
+def process_received_data(data, session):
+    """Parse and echo a received chunk in one write.
+
+    Returns the lines completed by the chunk.
+    """
+    metrics.inc("tcserver_bytes_received_total", len(data))
+    session.last_active = time.monotonic()
+    telnet = session.telnet
+    text = session.decode(telnet.feed(data))
+    output = telnet.take_replies()
+    if telnet.server_echo:
+        echo, lines = session.line_buffer.feed(
+            text, lambda line: command_processor.complete(line, session)
+        )
+        output += session.charset.encode(echo)
+    else:
+        _, lines = session.line_buffer.feed(text)
+    if output:
+        session.conn.sendall(output)
+    return lines
+
+
+def process_lines(session, lines):
+    """Process complete lines in order.
+
+    Lines are held back while the session is busy with a background
+    command, and processed once it finishes.
+    """
+    pending = session.pending_lines
+    pending.extend(lines)
+    while pending and not session.busy:
+        if session.conn.closing:
+            pending.clear()  # Client quit or was kicked mid-chunk
+            break
+        process_complete_line(pending.popleft(), session)
+
 
-    # Initialize buffers
-    input_buffer = b""
-    display_buffer = b""
+def handle_client(session):
+    """
+    Handles individual client connections.
 
+    Args:
+        session (Session): Session of a client opened by the accept loop,
+            or taken over from the previous server process
+    """
+    conn = session.conn
     try:
+        with gate:
+            if session.room is None:  # Not welcomed yet
+                # Give the client a moment to report its window size first
+                deadline = time.monotonic() + NEGOTIATION_TIMEOUT
+                while session.telnet.awaiting_window_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not conn.wait_readable(remaining):
+                        break
+                    data = conn.recv(1024)
+                    if not data:
+                        return
+                    lines = process_received_data(data, session)
+                    session.pending_lines.extend(lines)
+                send_welcome(session)
+            process_lines(session, ())
+
         while True:
-            # Receive data from client
-            data = conn.recv(1024)
+            # Wait outside the gate, so a handoff never waits on a quiet
+            # client; input arriving meanwhile is left to the new process
+            conn.wait_readable()
+            with gate:
+                # Receive data from client
+                data = conn.recv(1024)
+                if not data:
+                    break
+
+                process_lines(session, process_received_data(data, session))
+    except OSError:
+        pass  # Socket closed by /quit, /kick or the peer
+
+    finally:
+        # Clean up disconnected client
+        with gate:
+            cleanup_client_connection(session)
+        admission.release(session.addr[0])
+
+
+def reject_connection(reason):
+    """Count a connection turned away by admission control."""
+    metrics.inc("tcserver_connections_rejected_total", labels=f'reason="{reason}"')
+
+
+def cleanup_client_connection(session):
+    """Clean up resources when a client disconnects."""
+    if not user_manager.remove_session(session):
+        return  # Already cleaned up (e.g. after /quit)
+    print(f"Client {session.addr} disconnected")
+    log_connection(session, "DISCONNECT")
+    room_manager.leave_current_room(session)
+    announce(f"* User {session.username} disconnected")
+
+
+async def handle_client_async(reader, writer):
+    """
+    Handles an individual client connection as a coroutine.
+
+    Args:
+        reader (asyncio.StreamReader): Client input stream
+        writer (asyncio.StreamWriter): Client output stream
+    """
+    addr = writer.get_extra_info("peername")[:2]
+    reason = admission.admit(addr[0])
+    if reason:
+        reject_connection(reason)
+        writer.write(REJECTIONS[reason])  # Buffered, never waits on the client
+        writer.close()
+        return
+
+    conn = StreamConnection(writer)
+    enable_keepalive(writer.get_extra_info("socket"), KEEPALIVE_INTERVAL)
+    session = Session(conn, addr)
+    open_client_session(session)
+    await serve_client_async(reader, session)
+
+
+async def serve_client_async(reader, session):
+    """Serve a client until it disconnects.
+
+    Args:
+        reader (asyncio.StreamReader): Client input stream
+        session (Session): Session of a new client, or of one taken over
+            from the previous server process
+    """
+    conn = session.conn
+    try:
+        if session.room is None:  # Not welcomed yet
+            # Give the client a moment to report its window size first
+            deadline = time.monotonic() + NEGOTIATION_TIMEOUT
+            while session.telnet.awaiting_window_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    data = await asyncio.wait_for(reader.read(1024), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    return
+                session.pending_lines.extend(process_received_data(data, session))
+            send_welcome(session)
+        process_lines(session, ())
+
+        while True:
+            data = await reader.read(1024)
             if not data:
                 break
 
-            # Process each byte for display
-            for byte in data:
-                display_buffer = process_input_byte(byte, display_buffer, conn)
+            process_lines(session, process_received_data(data, session))
+    except ConnectionError:
+        pass
 
-            # Handle complete lines
-            input_buffer += data
-            if b"\r" in input_buffer:
-                # Split into complete line and remaining buffer
-                line, *remaining = input_buffer.split(b"\r", 1)
-                input_buffer = remaining[0] if remaining else b""
-                display_buffer = b""
+    finally:
+        cleanup_client_connection(session)
+        conn.close()
+        admission.release(session.addr[0])
 
-                # Remove trailing LF if present
-                if input_buffer.startswith(b"\n"):
-                    input_buffer = input_buffer[1:]
 
-                process_complete_line(line, addr, active_connections, conn)
+def restore_session(conn, state):
+    """Register a client taken over from the previous server process."""
+    session = Session.restore(conn, state)
+    admission.adopt(session.addr[0])
+    user_manager.register_session(session, state["username"])
+    if state["room"] and not room_manager.join_room(session, state["room"]):
+        room_manager.join_room(session, "lounge")  # Room gone meanwhile
+    idle_reaper.watch(session, state["idle"])
+    if state["unsent"]:
+        conn.sendall(state["unsent"].encode("latin-1"))
+    return session
 
-    finally:
-        # Clean up disconnected client
-        cleanup_client_connection(addr)
 
+def open_console():
+    """Create the admin session used by the server console."""
+    # The console is not a network client, so it stays out of the registry
+    console = Session(None, ("console", 0))
+    console.username = "admin"
+    console.role = "admin"
+    room_manager.join_room(console, "lounge")
+    return console
 
-def cleanup_client_connection(addr):
-    """Clean up resources when a client disconnects."""
-    print(f"Client {addr} disconnected")
-    log_connection(addr, "DISCONNECT")
-    username = user_manager.get_username(addr)
-    room_manager.leave_current_room(addr)
-    with connections_lock:
-        del active_connections[addr]
-    broadcast_message(
-        active_connections, f"* User {username} disconnected", system_msg=True
-    )
 
+def handle_server_input(loop=None):
+    """Handle input from server console.
 
-def handle_server_input():
-    """Handle input from server console."""
-    fake_addr = ("console", 0)
-    user_manager.register_session(fake_addr, "admin")
-    room_manager.join_room(fake_addr, "lounge")
+    When an event loop is given, lines are processed on that loop rather
+    than in the console thread.
+    """
+    console = open_console()
 
     while True:
         try:
             message = input()
             if message.strip():
-                process_complete_line(
-                    message.encode("ascii"), fake_addr, active_connections, None
-                )
+                args = (message, console)
+                if loop:
+                    loop.call_soon_threadsafe(process_complete_line, *args)
+                else:
+                    gated(process_complete_line, *args)
         except EOFError:
             break
 
 
-def start_server():
-    """Starts the server and listens for incoming connections."""
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+def deliver_remote_chat(room_name, message):
+    """Deliver a chat message posted on another worker or node."""
+    room = room_manager.rooms.get(room_name)
+    if room is None:
+        return
+    deliver_chat(room, message)
+
+
+def kick_user(username):
+    """Disconnect a user kicked on another worker or node."""
+    disconnect(user_manager.find_sessions(username))
+
+
+def disconnect(sessions, notice=KICKED):
+    """Send a notice (by default the kick notice) to sessions and close them."""
+    for target in list(sessions):
+        if target.conn:
+            target.conn.sendall(target.constant(notice))
+            target.conn.close()
+
+
+def apply_remote_ban(kind, target, expires):
+    """Apply a ban made on another worker or node and disconnect its targets."""
+    user_manager.bans.add(kind, target, expires)
+    if kind == "user":
+        disconnect(user_manager.find_sessions(target), BANNED)
+    else:
+        disconnect(user_manager.sessions_in_network(parse_network(target)), BANNED)
+
+
+def publish_presence():
+    """Tell the other workers or nodes who is online here, on changes."""
+    published = None
+    while True:
+        with user_manager.sessions_lock:
+            users = {s.username: s.room for s in active_connections.values()}
+        if users != published:
+            publish("presence", presence_source, users)
+            published = users
+        time.sleep(PRESENCE_INTERVAL)
+
+
+def start_links(loop=None):
+    """Start handling events from the other workers and nodes.
+
+    When an event loop is given, events are handled on that loop.
+    """
+    user_manager.publish = room_manager.publish = publish
+    handlers = {
+        "chat": deliver_remote_chat,
+        "announce": lambda message: broadcast_message(
+            active_connections.values(), message, system_msg=True
+        ),
+        "user": user_manager.update_user,
+        "room": room_manager.add_remote_room,
+        "ban": apply_remote_ban,
+        "unban": user_manager.bans.remove,
+        "kick": kick_user,
+        "msg": messenger.deliver,
+        "presence": user_manager.set_remote_users,
+        "exit": lambda: shutdown(None, None),
+    }
+    dispatch = loop.call_soon_threadsafe if loop else gated
+    if bus:
+        if bus.worker_id == 0:
+            # The supervisor's console input is handled by the first worker
+            console = open_console()
+            handlers["console"] = lambda line: process_complete_line(line, console)
+        bus.start(handlers, dispatch)
+    if cluster:
+        cluster.start(handlers, dispatch)
+
+    presence_thread = threading.Thread(target=publish_presence)
+    presence_thread.daemon = True
+    presence_thread.start()
+
+
+def serve_metrics():
+    """Serve /metrics if a port is configured, one port per worker."""
+    if METRICS_PORT and metrics.enabled:
+        metrics.serve(METRICS_PORT + (bus.worker_id if bus else 0))
+
+
+def gated(function, *args):
+    """Call function inside the gate; for work done by background threads."""
+    with gate:
+        function(*args)
+
+
+def run_in_background(target, *args):
+    """Run target in a daemon thread."""
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def start_server(takeover=None):
+    """Starts the server and listens for incoming connections.
+
+    takeover is what take_over() received from the server process being
+    replaced: its listening socket, clients and room history.
+    """
+    if takeover:
+        server = takeover[0]
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if bus:
+            # Every worker listens on the port, the kernel spreads clients
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server.bind((HOST, PORT))
-        server.listen(MAX_CONNECTIONS)
+    with server:
+        server.listen(LISTEN_BACKLOG)
         print(f"[TELTCSERVER] Listening on port {PORT}...")
         print(f"[TELTCSERVER] Maximum connections allowed: {MAX_CONNECTIONS}")
 
-        # Start server console input thread
-        console_thread = threading.Thread(target=handle_server_input)
-        console_thread.daemon = True
-        console_thread.start()
-
+        user_manager.rate_limiter.start_eviction()
+        idle_reaper.start(gate=gate)
+        serve_metrics()
+
+        if bus or cluster:
+            start_links()
+        if not bus:
+            # Start server console input thread
+            console_thread = threading.Thread(target=handle_server_input)
+            console_thread.daemon = True
+            console_thread.start()
+            signal.signal(
+                signal.SIGUSR2,
+                lambda signum, frame: run_in_background(hot_restart, server),
+            )
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: run_in_background(gated, reload_server),
+        )
+
+        if takeover:
+            _, clients, history = takeover
+            sessions = [
+                restore_session(SocketConnection(sock), state)
+                for state, sock in clients
+            ]
+            room_manager.restore_history(history)
+            for session in sessions:
+                run_in_background(handle_client, session)
+            print(f"[TELTCSERVER] Took over {len(sessions)} clients")
+
+        # Wait for clients outside the gate, accept them inside it
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
         while True:
-            conn, addr = server.accept()
+            selector.select()
+            with gate:
+                conn, addr = server.accept()
 
-            # Check if maximum connections reached
-            if len(active_connections) >= MAX_CONNECTIONS:
-                conn.sendall(b"Server is full. Please try again later.\r\n")
-                conn.close()
-                continue
+                # Turn away clients over the limits before spending a thread on them
+                reason = admission.admit(addr[0])
+                if reason:
+                    reject_connection(reason)
+                    refuse(conn, reason)
+                    continue
+
+                enable_keepalive(conn, KEEPALIVE_INTERVAL)
+                session = Session(SocketConnection(conn), addr)
+                open_client_session(session)
 
             # Create a new thread for each client
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr))
+            client_thread = threading.Thread(target=handle_client, args=(session,))
             client_thread.daemon = True  # Thread will close when main program exits
             client_thread.start()
 
 
+def shutdown(signum, frame):
+    """Flush buffered logs and exit on SIGTERM."""
+    event_log.close()
+    sys.stdout.flush()  # os._exit() drops buffered output, e.g. to a log file
+    # Skip interpreter cleanup, the console thread is blocked reading stdin
+    os._exit(0)
+
+
+def reload_server():
+    """Reload rooms, accounts, bans, banners and settings (SIGHUP)."""
+    storage.reload()
+    room_manager.reload()
+    user_manager.reload()
+    banner_cache.reload()
+    reload_settings()
+    print("[TELTCSERVER] Reloaded rooms, accounts, bans, banners and settings")
+
+
+def reload_settings():
+    """Apply the limits from a changed .env that the running server can
+    pick up; any other setting takes a restart (SIGUSR2)."""
+    global LOG_CHAT
+    # As at startup, variables set in the environment win over .env
+    for key, value in dotenv_values().items():
+        if key not in BASE_ENVIRON and value is not None:
+            os.environ[key] = value
+    env = os.getenv
+    admission.max_connections = int(env("MAX_CONNECTIONS", admission.max_connections))
+    admission.per_ip = int(env("MAX_CONNECTIONS_PER_IP", admission.per_ip))
+    admission.per_subnet = int(env("MAX_CONNECTIONS_PER_SUBNET", admission.per_subnet))
+    if env("ACCEPT_RATE"):
+        admission.bucket = TokenBucket(*parse_rate(env("ACCEPT_RATE")))
+    limiter = user_manager.rate_limiter
+    for kind in list(limiter.limits):
+        spec = env(f"RATE_LIMIT_{kind.upper()}")
+        if spec:
+            limiter.limits[kind] = parse_rate(spec)
+    if env("RATE_LIMIT_IP"):
+        limiter.ip_limit = parse_rate(env("RATE_LIMIT_IP"))
+    for session in list(active_connections.values()):
+        session.buckets.clear()  # Made again with the new limits
+    idle_reaper.guest_timeout = float(
+        env("IDLE_TIMEOUT_GUEST", idle_reaper.guest_timeout)
+    )
+    idle_reaper.user_timeout = float(env("IDLE_TIMEOUT_USER", idle_reaper.user_timeout))
+    idle_reaper.warning = float(env("IDLE_WARNING", idle_reaper.warning))
+    LOG_CHAT = env("LOG_CHAT", "1" if LOG_CHAT else "0") == "1"
+
+
+def handoff_ready():
+    """True once no password check is running and all output was sent."""
+    if user_manager.hash_pool.in_flight:
+        return False
+    return all(session.conn.flushed for session in active_connections.values())
+
+
+def hand_over(handoff, listener):
+    """Pass the listening socket, every client and the room history to the
+    new process; the caller has stopped all input first."""
+    sessions = []
+    for session in list(active_connections.values()):
+        if session.conn.closing:
+            continue  # Quit or kicked, let it go
+        state = session.export()
+        state["unsent"] = session.conn.take_unsent().decode("latin-1")
+        sessions.append((state, session.conn.fileno()))
+    handoff.send(listener, sessions, room_manager.export_history())
+    print(
+        f"[TELTCSERVER] Handed {len(sessions)} clients over to "
+        f"pid {handoff.process.pid}"
+    )
+
+
+def hot_restart(server):
+    """Restart without disconnecting anyone (SIGUSR2): start a new server
+    process and hand it the listening socket and every client."""
+    print("[TELTCSERVER] Restarting...")
+    handoff = Handoff(BASE_ENVIRON)
+    try:
+        handoff.spawn()
+        gate.close()
+        deadline = time.monotonic() + HANDOFF_FLUSH
+        while not handoff_ready() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        hand_over(handoff, server.fileno())
+    except (OSError, EOFError, ValueError) as error:
+        handoff.abort()
+        gate.open()
+        print(f"[TELTCSERVER] Restart failed, carrying on: {error}")
+        return
+    shutdown(None, None)
+
+
+async def hot_restart_async():
+    """hot_restart() for the async server, run on the event loop."""
+    global async_server
+    print("[TELTCSERVER] Restarting...")
+    loop = asyncio.get_running_loop()
+    handoff = Handoff(BASE_ENVIRON)
+    try:
+        await loop.run_in_executor(None, handoff.spawn)
+    except (OSError, EOFError, ValueError) as error:
+        handoff.abort()
+        print(f"[TELTCSERVER] Restart failed, carrying on: {error}")
+        return
+    # Stop accepting; the duplicate keeps the socket listening for the new
+    # process, with new clients waiting in its backlog
+    listener = os.dup(async_server.sockets[0].fileno())
+    async_server.close()
+    for session in list(active_connections.values()):
+        session.conn.writer.transport.pause_reading()
+    deadline = time.monotonic() + HANDOFF_FLUSH
+    while not handoff_ready() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    try:
+        # Blocks the loop on purpose, nothing may change from here on
+        hand_over(handoff, listener)
+    except (OSError, EOFError, ValueError) as error:
+        handoff.abort()
+        print(f"[TELTCSERVER] Restart failed, carrying on: {error}")
+        for session in list(active_connections.values()):
+            session.conn.writer.transport.resume_reading()
+        async_server = await asyncio.start_server(
+            handle_client_async,
+            sock=socket.socket(fileno=listener),
+            backlog=LISTEN_BACKLOG,
+        )
+        return
+    shutdown(None, None)
+
+
+async def start_async_server(takeover=None):
+    """Starts the server on a single asyncio event loop.
+
+    takeover is as for start_server().
+    """
+    global async_server
+    if takeover:
+        listen = {"sock": takeover[0]}
+    else:
+        listen = {"host": HOST, "port": PORT, "reuse_port": bus is not None}
+    async_server = await asyncio.start_server(
+        handle_client_async, backlog=LISTEN_BACKLOG, **listen
+    )
+    print(f"[TELTCSERVER] Listening on port {PORT} (async mode)...")
+    print(f"[TELTCSERVER] Maximum connections allowed: {MAX_CONNECTIONS}")
+
+    loop = asyncio.get_running_loop()
+    user_manager.rate_limiter.start_eviction()
+    idle_reaper.start(loop)
+    serve_metrics()
+    # Finish password hashing jobs back on the event loop
+    command_processor.defer = loop.call_soon_threadsafe
+    command_processor.resume = lambda session: process_lines(session, ())
+
+    if bus or cluster:
+        start_links(loop)
+    if not bus:
+        # The console still blocks on input(), so it keeps its own thread
+        console_thread = threading.Thread(target=handle_server_input, args=(loop,))
+        console_thread.daemon = True
+        console_thread.start()
+        loop.add_signal_handler(
+            signal.SIGUSR2, lambda: loop.create_task(hot_restart_async())
+        )
+    loop.add_signal_handler(signal.SIGHUP, reload_server)
+
+    if takeover:
+        _, clients, history = takeover
+        sessions = []
+        for state, sock in clients:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            sessions.append((reader, restore_session(StreamConnection(writer), state)))
+        room_manager.restore_history(history)
+        for reader, session in sessions:
+            loop.create_task(serve_client_async(reader, session))
+        print(f"[TELTCSERVER] Took over {len(sessions)} clients")
+
+    # Serve until the process exits; a failed restart replaces async_server
+    await loop.create_future()
+
+
+def run_worker(worker_id, pipe, base_environ):
+    """Entry point of a worker process started by the supervisor."""
+    global BASE_ENVIRON, bus, presence_source
+    # The worker inherits the .env values the supervisor loaded; a reload
+    # tells them from the real environment by the supervisor's own
+    BASE_ENVIRON = base_environ
+    signal.signal(signal.SIGTERM, shutdown)
+    bus = WorkerBus(worker_id, pipe)
+    presence_source = f"worker {worker_id}"
+    print(f"[TELTCSERVER] Worker {worker_id} started (pid {os.getpid()})")
+    if SERVER_MODE == "async":
+        asyncio.run(start_async_server())
+    else:
+        start_server()
+
+
+def run_supervisor():
+    """Run SERVER_WORKERS worker processes sharing the port."""
+    if STORAGE_BACKEND == "json":
+        print("[TELTCSERVER] Warning: use STORAGE_BACKEND=sqlite with several workers")
+    supervisor = Supervisor(SERVER_WORKERS, run_worker, BASE_ENVIRON)
+
+    def stop(signum, frame):
+        supervisor.terminate()
+        shutdown(signum, frame)
+
+    signal.signal(signal.SIGTERM, stop)
+    # Workers reload on their own; restarting them in place is not supported
+    signal.signal(signal.SIGHUP, lambda signum, frame: supervisor.send_signal(signum))
+    signal.signal(
+        signal.SIGUSR2,
+        lambda signum, frame: print(
+            "[TELTCSERVER] Hot restart needs SERVER_WORKERS=1, ignored"
+        ),
+    )
+
+    def forward_console():
+        while True:
+            try:
+                message = input()
+            except EOFError:
+                break
+            if message.strip():
+                supervisor.send(0, "console", message)
+
+    console_thread = threading.Thread(target=forward_console)
+    console_thread.daemon = True
+    console_thread.start()
+    supervisor.relay()
+
+
 if __name__ == "__main__":
-    start_server()
+    if SERVER_WORKERS > 1:
+        if CLUSTER_PORT:
+            print("[TELTCSERVER] Warning: clustering needs SERVER_WORKERS=1")
+        run_supervisor()
+    else:
+        signal.signal(signal.SIGTERM, shutdown)
+        takeover = None
+        if os.getenv(HANDOFF_ENV):
+            # Started by a hot restart: carry on with the old process's clients
+            takeover = take_over(os.environ[HANDOFF_ENV])
+            # Pick up what the old process changed while this one started
+            storage.reload()
+            room_manager.reload()
+            user_manager.reload()
+        if CLUSTER_PORT:
+            cluster = Cluster()
+            presence_source = f"node {CLUSTER_NODE}"
+        if SERVER_MODE == "async":
+            asyncio.run(start_async_server(takeover))
+        else:
+            start_server(takeover)
@@ -0,0 +1,396 @@
+"""Load test the server with a swarm of simulated telnet clients.
+
+    python tools/benchmark.py --clients 1000 --rooms 10 --duration 30
+    python tools/benchmark.py --port 2323 --server-pid 1234   # running server
+
+By default a server is started for the run, with its rate limits and
+password hashing relaxed so thousands of clients can log in quickly.
+Every client registers and logs in, joins a room and chats; senders
+either paste whole lines or type them a byte at a time. Some clients
+can be made slow readers to exercise the outbound queues.
+
+Reported, and saved as JSON with --output:
+- connections per second while the swarm connects
+- fan-out latency: a message sent until other room members receive it
+- echo latency: a message sent until the server sends it back to its sender
+- server RSS and CPU time per connection (Linux, read from /proc)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Refuse NAWS so the server sends its banner without waiting for a size
+TELNET_HELLO = b"\xff\xfc\x1f\xff\xfc\x22"
+PASSWORD = "bench"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def percentiles(samples):
+    """Summarize latencies in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))], 3)
+
+    return {
+        "count": len(samples),
+        "p50": at(0.50),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(samples[-1], 3),
+    }
+
+
+def process_usage(pid):
+    """Return (RSS in bytes, CPU seconds) of a process, or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(l.split()[1]) * 1024 for l in f if l.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        return rss, cpu
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+
+
+def start_server(args, workdir):
+    """Start main.py for the run; returns the process."""
+    env = dict(
+        os.environ,
+        PORT=str(args.port),
+        SERVER_MODE=args.mode,
+        SERVER_WORKERS="1",
+        MAX_CONNECTIONS=str(args.clients + 16),
+        MAX_CONNECTIONS_PER_IP="0",  # Every client comes from localhost
+        MAX_CONNECTIONS_PER_SUBNET="0",
+        ACCEPT_RATE="1000000/1",
+        DATA_DIR=workdir,
+        LOG_DIR=os.path.join(workdir, "logs"),
+        PASSWORD_HASH="pbkdf2",
+        PBKDF2_ITERATIONS="1000",
+        HASH_QUEUE_LIMIT=str(args.clients + 16),
+        HASH_PER_IP=str(args.clients + 16),
+        RATE_LIMIT_IP="1000000/1",
+        RATE_LIMIT_COMMAND="1000/1",
+        RATE_LIMIT_CHAT="1000/1",
+        HISTORY_REPLAY="0",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=ROOT,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=open(os.path.join(workdir, "server.log"), "w"),
+        stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("Server did not start, see server.log")
+
+
+class Stats:
+    def __init__(self):
+        self.connect_ms = []
+        self.fanout_ms = []
+        self.echo_ms = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.ready = 0
+
+
+class Client:
+    """One simulated user."""
+
+    def __init__(self, number, args, stats, room):
+        self.name = f"bench{number}"
+        self.number = number
+        self.args = args
+        self.stats = stats
+        self.room = room
+        self.slow = number < args.clients * args.slow_readers
+        self.sender = not self.slow and random.random() < args.senders
+        self.reader = None
+        self.writer = None
+        self.buffer = b""
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(
+            self.args.host, self.args.port
+        )
+        self.writer.write(TELNET_HELLO)
+        await self.expect(b"Type '/help'")
+        self.stats.connect_ms.append((time.perf_counter() - started) * 1000)
+
+    async def expect(self, *markers, timeout=30):
+        """Read until one of the markers arrives; returns that marker."""
+        deadline = time.monotonic() + timeout
+        while True:
+            for marker in markers:
+                if marker in self.buffer:
+                    self.buffer = self.buffer.partition(marker)[2]
+                    return marker
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(markers)
+            data = await asyncio.wait_for(self.reader.read(65536), remaining)
+            if not data:
+                raise ConnectionError("closed by server")
+            self.buffer += data
+
+    async def command(self, line, *replies):
+        """Send a command and wait for one of the expected replies.
+
+        Retried while the server's password hashing pool is busy.
+        """
+        while True:
+            self.writer.write(line.encode("ascii") + b"\r\n")
+            reply = await self.expect(b"Server busy", *replies)
+            if reply != b"Server busy":
+                return reply
+            await asyncio.sleep(0.05)
+
+    async def log_in(self, password=PASSWORD, register=True):
+        if register:
+            await self.command(
+                f"/register {self.name} {password}", b"registered", b"already exists"
+            )
+        reply = await self.command(
+            f"/login {self.name} {password}", b"Successfully", b"Invalid"
+        )
+        if reply != b"Successfully":
+            raise ConnectionError(f"could not log in as {self.name}")
+        await self.command(f"/join {self.room}", b"Joined room")
+        self.buffer = b""
+
+    async def chat(self, until):
+        """Send messages until the deadline while reading in the background."""
+        reading = asyncio.ensure_future(self.read_loop())
+        try:
+            if not self.sender:
+                await asyncio.sleep(max(0, until - time.monotonic()))
+                return
+            interval = 1 / self.args.rate
+            seq = 0
+            await asyncio.sleep(random.random() * interval)
+            while time.monotonic() < until:
+                seq += 1
+                await self.send(seq)
+                await asyncio.sleep(interval)
+        finally:
+            reading.cancel()
+
+    async def send(self, seq):
+        body = f"BENCH {self.number} {seq} "
+        padding = "x" * max(0, self.args.message_size - len(body) - 20)
+        if self.args.typing:
+            # Type the line, then stamp it just before the final keys
+            for char in f"{body}{padding} ":
+                self.writer.write(char.encode("ascii"))
+                await self.writer.drain()
+                await asyncio.sleep(self.args.typing_delay)
+            stamp = f"{time.perf_counter_ns()}\r\n"
+            self.writer.write(stamp.encode("ascii"))
+        else:
+            line = f"{body}{padding} {time.perf_counter_ns()}\r\n"
+            self.writer.write(line.encode("ascii"))
+        self.stats.sent += 1
+        await self.writer.drain()
+
+    async def read_loop(self):
+        buffer = b""
+        while True:
+            if self.slow:
+                data = await self.reader.read(256)
+                await asyncio.sleep(self.args.slow_delay)
+            else:
+                data = await self.reader.read(65536)
+            if not data:
+                return
+            now = time.perf_counter_ns()
+            *lines, buffer = (buffer + data).split(b"\r\n")
+            for line in lines:
+                self.measure(line, now)
+
+    def measure(self, line, now):
+        start = line.find(b"]: BENCH ")
+        if start < 0:
+            return
+        parts = line[start + 3 :].split()
+        try:
+            sender, stamp = int(parts[1]), int(parts[-1])
+        except (IndexError, ValueError):
+            return
+        latency = (now - stamp) / 1e6
+        if sender == self.number:
+            self.stats.echo_ms.append(latency)
+        elif not self.slow:
+            self.stats.fanout_ms.append(latency)
+            self.stats.received += 1
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+async def run_swarm(args, server_pid):
+    stats = Stats()
+    rooms = [f"bench{n}" for n in range(args.rooms)]
+
+    # An admin creates the rooms
+    admin = Client(-1, args, Stats(), "lounge")
+    admin.name = "admin"
+    await admin.connect()
+    await admin.log_in(args.admin_password, register=False)
+    for room in rooms:
+        await admin.command(f"/createroom {room}", b"created", b"already exists")
+    admin.close()
+
+    usage_before = process_usage(server_pid) if server_pid else None
+    clients = [
+        Client(n, args, stats, rooms[n % len(rooms)]) for n in range(args.clients)
+    ]
+
+    # Connect in batches of --concurrency
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def connect(client):
+        async with semaphore:
+            try:
+                await client.connect()
+            except (OSError, asyncio.TimeoutError, ConnectionError):
+                stats.errors += 1
+                client.writer = None
+
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_seconds = time.perf_counter() - started
+    clients = [client for client in clients if client.writer]
+
+    async def log_in(client):
+        async with semaphore:
+            try:
+                await client.log_in()
+                stats.ready += 1
+            except (OSError, asyncio.TimeoutError, ConnectionError):
+                stats.errors += 1
+
+    await asyncio.gather(*(log_in(client) for client in clients))
+    usage_connected = process_usage(server_pid) if server_pid else None
+
+    until = time.monotonic() + args.duration
+    await asyncio.gather(
+        *(client.chat(until) for client in clients), return_exceptions=True
+    )
+    usage_after = process_usage(server_pid) if server_pid else None
+    for client in clients:
+        client.close()
+
+    result = {
+        "clients": args.clients,
+        "connected": len(clients),
+        "logged_in": stats.ready,
+        "errors": stats.errors,
+        "connections_per_second": round(len(clients) / connect_seconds, 1),
+        "connect_ms": percentiles(stats.connect_ms),
+        "messages_sent": stats.sent,
+        "messages_received": stats.received,
+        "fanout_ms": percentiles(stats.fanout_ms),
+        "echo_ms": percentiles(stats.echo_ms),
+    }
+    if usage_before and usage_connected and usage_after and clients:
+        result["server_rss_bytes"] = usage_after[0]
+        result["rss_per_connection_bytes"] = round(
+            (usage_connected[0] - usage_before[0]) / len(clients)
+        )
+        result["cpu_seconds"] = round(usage_after[1] - usage_connected[1], 2)
+        result["cpu_ms_per_connection"] = round(
+            (usage_after[1] - usage_connected[1]) * 1000 / len(clients), 3
+        )
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2399)
+    parser.add_argument("--server-pid", type=int, help="benchmark a running server")
+    parser.add_argument("--mode", default="threaded", help="SERVER_MODE to start")
+    parser.add_argument("--admin-password", default="admin")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="connects at once")
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of chat")
+    parser.add_argument("--senders", type=float, default=0.1, help="share that chat")
+    parser.add_argument("--rate", type=float, default=1, help="messages/s per sender")
+    parser.add_argument("--message-size", type=int, default=60)
+    parser.add_argument("--typing", action="store_true", help="send byte by byte")
+    parser.add_argument("--typing-delay", type=float, default=0.005)
+    parser.add_argument("--slow-readers", type=float, default=0.0, help="share")
+    parser.add_argument("--slow-delay", type=float, default=0.5)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tcserver-bench-") as workdir:
+        server = None
+        server_pid = args.server_pid
+        if server_pid is None:
+            server = start_server(args, workdir)
+            server_pid = server.pid
+        try:
+            result = asyncio.run(run_swarm(args, server_pid))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    result = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("admin_password", "output")
+        },
+        **result,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Start a three node cluster on localhost.
+
+    python tools/cluster_harness.py            # run until Ctrl-C
+    python tools/cluster_harness.py --check    # check that nodes share chat
+
+Node N listens for telnet clients on --port + N and for the other nodes
+on --backbone-port + N. Each node keeps its data and logs in its own
+temporary directory.
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NODES = 3
+
+
+def start_nodes(port, backbone_port, workdir):
+    """Start the nodes; returns their processes."""
+    backbone = [f"127.0.0.1:{backbone_port + n}" for n in range(NODES)]
+    processes = []
+    for n in range(NODES):
+        node_dir = os.path.join(workdir, f"node{n}")
+        os.makedirs(node_dir)
+        env = dict(
+            os.environ,
+            PORT=str(port + n),
+            CLUSTER_NODE=str(n),
+            CLUSTER_PORT=str(backbone_port + n),
+            CLUSTER_PEERS=",".join(backbone[:n] + backbone[n + 1 :]),
+            CLUSTER_SECRET="harness",
+            CLUSTER_HEARTBEAT="1",
+            DATA_DIR=node_dir,
+            LOG_DIR=os.path.join(node_dir, "logs"),
+            SERVER_WORKERS="1",
+        )
+        output = open(os.path.join(node_dir, "server.log"), "w")
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, "main.py"],
+                cwd=ROOT,
+                env=env,
+                stdin=subprocess.PIPE,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+            )
+        )
+        print(f"node{n}: telnet port {port + n}, backbone port {backbone_port + n}")
+    return processes
+
+
+def read(sock, wait=0.5):
+    """Return whatever the server sends within wait seconds."""
+    sock.settimeout(wait)
+    data = b""
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    return data.decode("ascii", "replace")
+
+
+def check(port):
+    """Log in on every node and check a message posted on one reaches all."""
+    clients = [socket.create_connection(("127.0.0.1", port + n)) for n in range(NODES)]
+    for client in clients:
+        read(client, 1.0)
+        client.sendall(b"/login admin admin\r\n")
+    time.sleep(1.0)
+    for client in clients:
+        read(client)
+
+    clients[0].sendall(b"hello from node0\r\n")
+    received = ["hello from node0" in read(client) for client in clients[1:]]
+    time.sleep(2.0)  # Let presence updates go round
+    clients[1].sendall(b"/users\r\n")
+    users = read(clients[1])
+    for client in clients:
+        client.close()
+
+    print(users.strip())
+    ok = all(received) and "node 0: admin" in users and "node 2: admin" in users
+    print("OK" if ok else f"FAILED (chat delivered: {received})")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=2323)
+    parser.add_argument("--backbone-port", type=int, default=7323)
+    parser.add_argument("--check", action="store_true", help="run a check and exit")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tcserver-cluster-") as workdir:
+        processes = start_nodes(args.port, args.backbone_port, workdir)
+        try:
+            time.sleep(3.0)  # Startup, then the first round of dialing
+            if args.check:
+                return 0 if check(args.port) else 1
+            print("Cluster running, press Ctrl-C to stop")
+            while all(process.poll() is None for process in processes):
+                time.sleep(1)
+            print("A node exited, see its server.log")
+            return 1
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())